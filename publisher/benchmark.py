@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+"""
+Benchmark the publisher on a reproducible synthetic vault.
+
+A vault of --notes notes is generated from --seed. The notes have YAML headers, wikilinks and
+image embeds, and the images come in several sizes and alpha modes. The vault has a git history
+that includes renames. Every stage of publishing is then timed on its own, --repeat times:
+
+  yaml_parse        split_yaml_header + yaml.safe_load of every note
+  yaml_dump         yaml.dump of every parsed header
+  regex_rewrite     publisher.rewrite_links, the embed and wikilink rewrites of process_file
+  git_dates         CreationDateResolver.resolve for every note, without a cache
+  image_index       build_image_index over the image directories, without a cache
+  decode_resize     imaging.load_for_web of every image
+  webp_encode       full-size WebP encode of every image, in memory
+  png_encode        full-size PNG encode of every image, in memory
+  publish           process_file for every note into an empty site, serially
+  publish_cached    the same again, with every image skipped by the manifest
+  optimize_existing optimize_existing_images.optimize_image for every image
+
+The report is JSON and records the commit, the environment and the vault config. Pass an
+earlier report as --compare to print the change per stage and exit with status 1 if any
+stage slowed down by more than --threshold.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+import git
+import inflection
+import numpy as np
+import PIL
+import yaml
+from PIL import Image, ImageDraw
+
+import optimize_existing_images
+from image_manifest import ImageManifest
+from imaging import PNG_OPTIONS, PROFILES, flatten, load_for_web, save_lossy
+from publisher import (IMAGE_PARAMS, SITE_DIR, CreationDateResolver, build_image_index, find_notes, process_file,
+                       rewrite_links, split_yaml_header)
+
+REPORT_VERSION = 1
+
+# (mode, file extension) of the generated images, cycled through in order
+IMAGE_KINDS = (('RGB', '.jpg'), ('RGBA', '.png'), ('LA', '.png'), ('P', '.png'), ('RGB', '.png'))
+
+WORDS = """
+cache latency throughput vector kernel page table branch predictor pipeline stall memory
+bandwidth thread lock atomic queue graph tree heap hash index shard replica log compaction
+scheduler interrupt syscall buffer socket packet window congestion protocol compiler register
+""".split()
+
+
+def parse_size(text):
+    width, _, height = text.partition('x')
+    return int(width), int(height)
+
+
+def _words(rng, count):
+    return ' '.join(rng.choice(WORDS) for _ in range(count))
+
+
+def _image(rng, mode, size, seed):
+    """A photo-like image (gradients and noise) for JPEGs, a flat diagram for everything else."""
+    width, height = size
+    if mode == 'RGB' and seed % 2 == 0:
+        noise = np.random.default_rng(seed)
+        y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+        base = 128 + 60 * np.sin(x / rng.uniform(20, 200)) + 40 * np.cos(y / rng.uniform(20, 200))
+        channels = [base + noise.normal(0, 12, (height, width)) for _ in range(3)]
+        return Image.fromarray(np.stack(channels, 2).clip(0, 255).astype('uint8'))
+
+    img = Image.new('RGBA', size, (255, 255, 255, 0 if mode in ('RGBA', 'LA') else 255))
+    draw = ImageDraw.Draw(img)
+    for _ in range(12):
+        left, top = rng.randrange(width), rng.randrange(height)
+        box = (left, top, min(width, left + rng.randrange(20, width // 2 + 21)), min(height, top + rng.randrange(20, height // 2 + 21)))
+        draw.rectangle(box, fill=(rng.randrange(256), rng.randrange(256), rng.randrange(256), rng.randrange(128, 256)), outline=(0, 0, 0, 255), width=3)
+    if mode == 'P':
+        return img.convert('RGB').convert('P', palette=Image.Palette.ADAPTIVE)
+    return img.convert(mode)
+
+
+def generate_vault(vault_dir, notes=200, images=40, embeds_per_note=2, links_per_note=5, header_keys=4,
+                   image_sizes=((800, 600), (1920, 1080), (4000, 3000)), renames=0.1, seed=0):
+    """
+    Write a synthetic Obsidian vault to vault_dir and commit it to a new git repository:
+    the notes in ten commits with increasing dates, then a commit renaming a fraction of them.
+
+    Returns: (list of note paths, list of image directories)
+    """
+    rng = random.Random(seed)
+    image_dirs = [os.path.join(vault_dir, 'files', 'diagrams'), os.path.join(vault_dir, 'files', 'photos')]
+    for directory in image_dirs:
+        os.makedirs(directory)
+
+    image_names = []
+    for i in range(images):
+        mode, extension = IMAGE_KINDS[i % len(IMAGE_KINDS)]
+        name = f'figure {i:04d}{extension}'
+        _image(rng, mode, rng.choice(image_sizes), seed + i).save(os.path.join(image_dirs[i % 2], name))
+        image_names.append(name)
+
+    titles = [f'Note {i:04d} {_words(rng, 2)}' for i in range(notes)]
+    paths = []
+    for i, title in enumerate(titles):
+        paragraphs = [_words(rng, 50) for _ in range(6)]
+        for _ in range(links_per_note):
+            paragraph = rng.randrange(len(paragraphs))
+            paragraphs[paragraph] += f' see [[{rng.choice(titles)}]]'
+        for _ in range(embeds_per_note if image_names else 0):
+            paragraphs.insert(rng.randrange(len(paragraphs) + 1), f'![[{rng.choice(image_names)}]]')
+
+        body = '\n\n'.join(paragraphs) + '\n'
+        # One note in ten has no header, like scratch notes in a real vault
+        if i % 10:
+            header = {'tags': [rng.choice(WORDS) for _ in range(3)], 'aliases': [_words(rng, 2)]}
+            header.update({f'key{k}': _words(rng, 3) for k in range(header_keys)})
+            body = '---\n' + yaml.dump(header) + '---\n' + body
+        path = os.path.join(vault_dir, f'{title}.md')
+        with open(path, 'w') as file:
+            file.write(body)
+        paths.append(path)
+
+    repo = git.Repo.init(vault_dir)
+    identity = {'GIT_AUTHOR_NAME': 'Benchmark', 'GIT_AUTHOR_EMAIL': 'benchmark@example.com',
+                'GIT_COMMITTER_NAME': 'Benchmark', 'GIT_COMMITTER_EMAIL': 'benchmark@example.com'}
+    batches = [paths[i::10] for i in range(10)]
+    for day, batch in enumerate(batches + [None]):
+        date = f'2024-01-{day + 1:02d}T12:00:00+00:00'
+        with repo.git.custom_environment(GIT_AUTHOR_DATE=date, GIT_COMMITTER_DATE=date, **identity):
+            if batch is None:
+                for index in sorted(rng.sample(range(notes), int(notes * renames))):
+                    renamed = os.path.join(vault_dir, f'{titles[index]} renamed.md')
+                    repo.git.mv(paths[index], renamed)
+                    paths[index] = renamed
+                repo.git.commit('-q', '--allow-empty', '-m', 'Rename notes')
+            else:
+                repo.git.add('--', *batch, *(os.path.join(directory, name) for directory in image_dirs for name in os.listdir(directory)))
+                repo.git.commit('-q', '--allow-empty', '-m', f'Add notes, batch {day}')
+    return paths, image_dirs
+
+
+def _time(stage, repeat, run):
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        items = run()
+        runs.append(time.perf_counter() - start)
+    return stage, {'items': items, 'runs': [round(seconds, 6) for seconds in runs],
+                   'median': round(statistics.median(runs), 6), 'min': round(min(runs), 6)}
+
+
+def run_stages(notes, image_dirs, work_dir, repeat=3, profile='release', stages=None):
+    """Time every stage listed (all by default) on the vault. Returns {stage: timings}."""
+    params = dict(IMAGE_PARAMS, profile=profile) if profile == 'draft' else IMAGE_PARAMS
+    contents = []
+    for path in notes:
+        with open(path) as file:
+            contents.append(file.read())
+    headers = [yaml.safe_load(header) if header else {} for header, _ in map(split_yaml_header, contents)]
+    image_index = build_image_index(image_dirs)
+    images = sorted(paths[0] for paths in image_index.values())
+    decoded = [load_for_web(path, IMAGE_PARAMS['max_width'])[0] for path in images]
+    flattened = [flatten(img) for img in decoded]
+
+    def yaml_parse():
+        for text in contents:
+            header, _ = split_yaml_header(text)
+            if header:
+                yaml.safe_load(header)
+        return len(contents)
+
+    def yaml_dump():
+        for header in headers:
+            yaml.dump(header)
+        return len(headers)
+
+    output_names = {inflection.parameterize(os.path.splitext(name)[0]): inflection.parameterize(os.path.splitext(name)[0]) for name in image_index}
+
+    def regex_rewrite():
+        for path, text in zip(notes, contents):
+            _, body = split_yaml_header(text)
+            rewrite_links(body, f'/blog/{inflection.parameterize(os.path.splitext(os.path.basename(path))[0])}', output_names, params['formats'])
+        return len(contents)
+
+    def git_dates():
+        CreationDateResolver().resolve(notes)
+        return len(notes)
+
+    def image_index_stage():
+        build_image_index(image_dirs)
+        return len(images)
+
+    def decode_resize():
+        for path in images:
+            load_for_web(path, IMAGE_PARAMS['max_width'])
+        return len(images)
+
+    def webp_encode():
+        for img in flattened:
+            save_lossy(img, io.BytesIO(), 'webp', IMAGE_PARAMS['webp_quality'], profile)
+        return len(flattened)
+
+    def png_encode():
+        for img in decoded:
+            img.save(io.BytesIO(), 'PNG', **PNG_OPTIONS[profile])
+        return len(decoded)
+
+    site = {}
+
+    def publish(cached=False):
+        if not cached:
+            site['dir'] = tempfile.mkdtemp(dir=work_dir)
+            for name in ('content', 'images'):
+                os.makedirs(os.path.join(site['dir'], name))
+        content_dir, images_dir = (os.path.join(site['dir'], name) for name in ('content', 'images'))
+        manifest = ImageManifest(os.path.join(site['dir'], 'images.json'), images_dir)
+        dates = CreationDateResolver()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for path in notes:
+                if process_file(path, content_dir, image_index, images_dir, manifest=manifest, dates=dates, params=params) is None:
+                    raise RuntimeError(f'process_file failed for {path}')
+        manifest.save()
+        return len(notes)
+
+    def optimize_existing():
+        output_dir = tempfile.mkdtemp(dir=work_dir)
+        image_params = dict(optimize_existing_images.IMAGE_PARAMS, profile=profile)
+        with contextlib.redirect_stdout(io.StringIO()):
+            for i, path in enumerate(images):
+                if optimize_existing_images.optimize_image(path, output_dir, f'image-{i}', **image_params)[2] is None:
+                    raise RuntimeError(f'optimize_image failed for {path}')
+        return len(images)
+
+    available = {
+        'yaml_parse': yaml_parse,
+        'yaml_dump': yaml_dump,
+        'regex_rewrite': regex_rewrite,
+        'git_dates': git_dates,
+        'image_index': image_index_stage,
+        'decode_resize': decode_resize,
+        'webp_encode': webp_encode,
+        'png_encode': png_encode,
+        'publish': publish,
+        'publish_cached': lambda: publish(cached=True),
+        'optimize_existing': optimize_existing,
+    }
+    results = {}
+    for stage in stages or STAGES:
+        if stage == 'publish_cached' and 'dir' not in site:
+            # Needs a published site to be cached against
+            publish()
+        results.update([_time(stage, repeat, available[stage])])
+    return results
+
+
+STAGES = ('yaml_parse', 'yaml_dump', 'regex_rewrite', 'git_dates', 'image_index', 'decode_resize',
+          'webp_encode', 'png_encode', 'publish', 'publish_cached', 'optimize_existing')
+
+
+def _commit():
+    try:
+        repo = git.Repo(SITE_DIR)
+        return repo.head.commit.hexsha, repo.is_dirty()
+    except (git.InvalidGitRepositoryError, git.NoSuchPathError, ValueError):
+        return None, None
+
+
+def compare(report, baseline, threshold):
+    """
+    Print the change of every stage's median against baseline.
+
+    Returns: list of stages slower than threshold times their baseline median
+    """
+    if report['config'] != baseline['config']:
+        print('Warning: the vault config differs from the baseline, timings may not be comparable', file=sys.stderr)
+    regressions = []
+    print(f"{'stage':<20}{'baseline':>12}{'current':>12}{'ratio':>8}", file=sys.stderr)
+    for stage, timings in report['stages'].items():
+        before = baseline['stages'].get(stage)
+        if not before:
+            continue
+        ratio = timings['median'] / before['median'] if before['median'] else float('inf')
+        flag = ' slower' if ratio > threshold else ''
+        print(f"{stage:<20}{before['median']:>11.3f}s{timings['median']:>11.3f}s{ratio:>8.2f}{flag}", file=sys.stderr)
+        if ratio > threshold:
+            regressions.append(stage)
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Time every stage of the publisher on a reproducible synthetic vault and write a JSON report.")
+    parser.add_argument("--notes", type=int, default=200, help="Number of notes to generate (default: 200)")
+    parser.add_argument("--images", type=int, default=40, help="Number of images to generate (default: 40)")
+    parser.add_argument("--embeds-per-note", type=int, default=2, help="Image embeds per note (default: 2)")
+    parser.add_argument("--links-per-note", type=int, default=5, help="Wikilinks per note (default: 5)")
+    parser.add_argument("--header-keys", type=int, default=4, help="Extra YAML header keys per note, besides tags and aliases (default: 4)")
+    parser.add_argument("--image-sizes", nargs="+", type=parse_size, default=[(800, 600), (1920, 1080), (4000, 3000)], help="Image sizes to pick from, as WIDTHxHEIGHT (default: 800x600 1920x1080 4000x3000)")
+    parser.add_argument("--renames", type=float, default=0.1, help="Fraction of notes renamed in the last commit of the vault's history (default: 0.1)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the generated vault (default: 0)")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per stage; the report keeps every run, the median and the minimum (default: 3)")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES), help="Stages to time (default: all)")
+    parser.add_argument("--profile", choices=PROFILES, default="release", help="Encoder profile used by the image stages (default: release)")
+    parser.add_argument("--keep", help="Generate the vault in this empty directory and keep it, instead of a temporary one")
+    parser.add_argument("--output", help="Write the JSON report to this file (default: stdout)")
+    parser.add_argument("--compare", help="Earlier JSON report to compare against")
+    parser.add_argument("--threshold", type=float, default=1.10, help="With --compare, the median ratio above which a stage counts as a regression (default: 1.10)")
+    args = parser.parse_args()
+    if args.notes < 1 or args.repeat < 1:
+        parser.error("--notes and --repeat must be at least 1")
+    if not 0 <= args.renames <= 1:
+        parser.error(f"--renames must be between 0 and 1, got {args.renames}")
+    if args.keep and os.path.exists(args.keep) and os.listdir(args.keep):
+        parser.error(f"--keep directory {args.keep} is not empty")
+    return args
+
+
+def main():
+    args = parse_args()
+    config = {
+        'notes': args.notes,
+        'images': args.images,
+        'embeds_per_note': args.embeds_per_note,
+        'links_per_note': args.links_per_note,
+        'header_keys': args.header_keys,
+        'image_sizes': [list(size) for size in args.image_sizes],
+        'renames': args.renames,
+        'seed': args.seed,
+        'repeat': args.repeat,
+        'profile': args.profile,
+    }
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        vault_dir = args.keep or os.path.join(work_dir, 'vault')
+        os.makedirs(vault_dir, exist_ok=True)
+        print(f"Generating {args.notes} notes and {args.images} images in {vault_dir}", file=sys.stderr)
+        _, image_dirs = generate_vault(vault_dir, args.notes, args.images, args.embeds_per_note, args.links_per_note,
+                                       args.header_keys, args.image_sizes, args.renames, args.seed)
+        # Renames happened after the notes were written, so list them from disk
+        notes = find_notes(vault_dir)
+        print(f"Timing {len(args.stages)} stages, {args.repeat} runs each", file=sys.stderr)
+        stages = run_stages(notes, image_dirs, work_dir, args.repeat, args.profile, args.stages)
+
+    commit, dirty = _commit()
+    report = {
+        'version': REPORT_VERSION,
+        'commit': commit,
+        'dirty': dirty,
+        'environment': {
+            'python': platform.python_version(),
+            'pillow': PIL.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'config': config,
+        'stages': stages,
+    }
+
+    text = json.dumps(report, indent=1, sort_keys=True) + '\n'
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text)
+    else:
+        sys.stdout.write(text)
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(report, json.load(file), args.threshold)
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,272 @@
+"""
+Persistent record of the images encoded into the Hugo static/images directory.
+
+Shared by publisher.py and optimize_existing_images.py. Every entry is keyed by the
+output base name and remembers the content hash of the source it was encoded from,
+the encoder parameters used and the size of every output file, so an image whose
+source bytes and settings are unchanged is never encoded twice. The manifest lives
+in the Hugo data directory and is committed together with the images it describes.
+
+With fingerprinting, outputs are named <name>.<hash>.webp/png after the source bytes and
+encoder settings, so /images/* can be cached immutably: a changed image gets a new URL.
+"""
+
+import contextlib
+import hashlib
+import json
+import os
+import re
+
+MANIFEST_VERSION = 1
+DEFAULT_MANIFEST_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'images.json')
+
+# Hex digits of the content hash used in fingerprinted output names
+FINGERPRINT_LENGTH = 10
+
+# Width variants are named <base_name>-<width>w, see imaging.variant_name
+_WIDTH_SUFFIX = re.compile(r'-\d+w$')
+
+
+def release_params(params):
+    """The settings a draft encode (params with "profile": "draft") is upgraded to."""
+    return {key: value for key, value in params.items() if key != 'profile'}
+
+
+def hash_file(path, chunk_size=1 << 20):
+    """SHA-256 hex digest of a file's contents, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@contextlib.contextmanager
+def atomic_output(path):
+    """
+    Yield a hidden temporary path next to path and move it over path once the block
+    completes, so watchers such as `hugo server` never see a partially written file.
+    """
+    tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp{os.getpid()}")
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def write_json_atomic(path, data):
+    """Write data as JSON through a temporary file so readers never see a partial document."""
+    with atomic_output(path) as tmp_path:
+        with open(tmp_path, 'w') as file:
+            json.dump(data, file, indent=1, sort_keys=True, ensure_ascii=False)
+            file.write('\n')
+
+
+class ImageManifest:
+    """
+    Cache of encoded images backed by a JSON file.
+
+    Entries look like:
+        "<base_name>": {
+            "source_hash": "<sha256 of the source bytes>",
+            "source_stat": [<size>, <mtime_ns>],
+            "params": {"max_width": 1920, "webp_quality": 85, "png_optimize": true, "widths": [650, 1300]},
+            "outputs": {"<base_name>.webp": <size>, "<base_name>.png": <size>, "<base_name>-650w.webp": <size>, ...},
+            "width": 1920, "height": 1080,
+            "variants": [{"name": "<base_name>-650w", "width": 650, "height": 366}, ..., {"name": "<base_name>", "width": 1920, "height": 1080}]
+        }
+    width, height and variants describe the WebP outputs and are read by render-image.html.
+    "quality" is the WebP quality picked by an adaptive search, if one ran. Draft encodes carry
+    "profile": "draft" in their params and the "source_path" to upgrade them from.
+    Fingerprinted entries are keyed by <name>.<hash> and also store the plain "name".
+    """
+
+    def __init__(self, path, image_dir, refresh=False, fingerprint=False):
+        # With refresh, lookups always miss so every image is re-encoded and re-recorded
+        self.path = path
+        self.image_dir = image_dir
+        self.refresh = refresh
+        self.fingerprint = fingerprint
+        # Fingerprinted base name -> plain name, for the names handed out by output_name
+        self.names = {}
+        self.images = {}
+        self.dirty = False
+        if os.path.exists(path):
+            with open(path) as file:
+                data = json.load(file)
+            # An unknown layout is treated as an empty cache and rewritten on save
+            if data.get('version') == MANIFEST_VERSION:
+                self.images = data.get('images', {})
+
+    def _outputs_intact(self, entry):
+        for name, size in entry['outputs'].items():
+            try:
+                if os.path.getsize(os.path.join(self.image_dir, name)) != size:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def source_key(self, base_name, src_path):
+        """
+        Identify the current contents of src_path as {'source_hash', 'source_stat'}. The hash
+        recorded for base_name is reused without reading the file when its size and mtime
+        are unchanged since it was recorded.
+        """
+        stat = os.stat(src_path)
+        source_stat = [stat.st_size, stat.st_mtime_ns]
+        entry = self.images.get(base_name)
+        if entry and entry.get('source_stat') == source_stat:
+            return {'source_hash': entry['source_hash'], 'source_stat': source_stat}
+        return {'source_hash': hash_file(src_path), 'source_stat': source_stat}
+
+    def output_name(self, name, src_path, params):
+        """
+        Base name to encode src_path under: name itself, or with fingerprinting name.<hash>, where
+        the hash covers the source bytes and params and so changes exactly when the outputs would.
+        The profile is left out, so upgrading a draft keeps its name and the pages linking to it.
+        The source is only hashed when no fingerprint of name was recorded for its size and mtime.
+        """
+        if not self.fingerprint:
+            return name
+        stat = os.stat(src_path)
+        known = next((base_name for base_name, entry in self.images.items()
+                      if entry.get('name') == name and entry['source_stat'] == [stat.st_size, stat.st_mtime_ns]), name)
+        source = self.source_key(known, src_path)
+        digest = hashlib.sha256((source['source_hash'] + json.dumps(release_params(params), sort_keys=True)).encode()).hexdigest()
+        base_name = f"{name}.{digest[:FINGERPRINT_LENGTH]}"
+        self.names[base_name] = name
+        return base_name
+
+    def superseded(self, referenced):
+        """
+        Fingerprinted base names that are not in referenced while another fingerprint of the
+        same name is, i.e. older encodes of an image that no page links to anymore.
+        """
+        live = {entry['name'] for base_name, entry in self.images.items() if 'name' in entry and base_name in referenced}
+        return sorted(base_name for base_name, entry in self.images.items()
+                      if entry.get('name') in live and base_name not in referenced)
+
+    def chosen_quality(self, base_name, source, params):
+        """
+        WebP quality picked by an earlier adaptive search for the same source bytes and
+        search settings (ssim_target, max_bytes), or None if the search has to run again.
+        """
+        entry = self.images.get(base_name)
+        if self.refresh or entry is None or 'quality' not in entry or entry['source_hash'] != source['source_hash']:
+            return None
+        if any(entry['params'].get(key) != params.get(key) for key in ('ssim_target', 'max_bytes', 'max_width')):
+            return None
+        return entry['quality']
+
+    def satisfies(self, base_name, params):
+        """
+        True unless base_name was recorded with settings other than params. Release outputs
+        also satisfy a draft request, so drafting never downgrades an image.
+        """
+        entry = self.images.get(base_name)
+        if entry is None or entry['params'] == params:
+            return True
+        return params.get('profile') == 'draft' and entry['params'] == release_params(params)
+
+    def drafts(self):
+        """Base names of the entries encoded with the draft profile, in sorted order."""
+        return sorted(base_name for base_name, entry in self.images.items() if entry['params'].get('profile') == 'draft')
+
+    def intact(self, base_name):
+        """True if base_name is recorded and every one of its outputs is still on disk unchanged."""
+        entry = self.images.get(base_name)
+        return entry is not None and self._outputs_intact(entry)
+
+    def lookup(self, base_name, source, params):
+        """
+        Return the entry for base_name if it was encoded from the same source bytes with
+        the same parameters and every output is still on disk unchanged, else None.
+        """
+        entry = self.images.get(base_name)
+        if self.refresh or entry is None or entry['source_hash'] != source['source_hash'] or not self.satisfies(base_name, params):
+            return None
+        return entry if self._outputs_intact(entry) else None
+
+    def is_output(self, path):
+        """True if path is an unchanged output of some manifest entry, including width variants."""
+        name = os.path.basename(path)
+        stem = os.path.splitext(name)[0]
+        for base_name in (stem, _WIDTH_SUFFIX.sub('', stem)):
+            entry = self.images.get(base_name)
+            if entry is not None and name in entry['outputs']:
+                return self._outputs_intact(entry)
+        return False
+
+    def is_variant(self, path):
+        """True if path is a width variant recorded as an output of some entry, whether or not it is intact."""
+        name = os.path.basename(path)
+        stem = os.path.splitext(name)[0]
+        entry = self.images.get(_WIDTH_SUFFIX.sub('', stem))
+        return _WIDTH_SUFFIX.search(stem) is not None and entry is not None and name in entry['outputs']
+
+    def record(self, base_name, source, params, output_paths, **details):
+        """
+        Record outputs encoded from source, as returned by source_key before encoding.
+        details (e.g. width, height, variants) are stored on the entry for the Hugo templates.
+        Outputs of the previous entry that were not produced again, such as a width variant
+        the image is now too narrow for, are deleted.
+        """
+        outputs = {os.path.basename(path): os.path.getsize(path) for path in output_paths}
+        previous = self.images.get(base_name)
+        for name in set(previous['outputs']) - set(outputs) if previous else ():
+            path = os.path.join(self.image_dir, name)
+            if os.path.exists(path):
+                os.remove(path)
+        self.images[base_name] = {
+            'source_hash': source['source_hash'],
+            'source_stat': source['source_stat'],
+            'params': params,
+            'outputs': outputs,
+            **details,
+        }
+        # Re-encodes that never asked for output_name (e.g. upgrade_images.py) keep the recorded name
+        name = self.names.get(base_name) or (previous or {}).get('name')
+        if name:
+            self.images[base_name]['name'] = name
+        self.dirty = True
+
+    def discard(self, base_name):
+        """
+        Delete the outputs recorded for base_name and forget the entry.
+
+        Returns: list of deleted output paths
+        """
+        entry = self.images.pop(base_name, None)
+        if entry is None:
+            return []
+        removed = []
+        for name in entry['outputs']:
+            path = os.path.join(self.image_dir, name)
+            if os.path.exists(path):
+                os.remove(path)
+                removed.append(path)
+        self.dirty = True
+        return removed
+
+    def prune(self):
+        """
+        Evict entries whose outputs have been deleted from the image directory.
+
+        Returns: list of evicted base names
+        """
+        evicted = [name for name, entry in self.images.items()
+                   if not all(os.path.exists(os.path.join(self.image_dir, output)) for output in entry['outputs'])]
+        for name in evicted:
+            del self.images[name]
+        self.dirty = self.dirty or bool(evicted)
+        return evicted
+
+    def save(self):
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        write_json_atomic(self.path, {'version': MANIFEST_VERSION, 'images': self.images})
+        self.dirty = False
@@ -0,0 +1,349 @@
+"""
+Image encoding helpers shared by publisher.py and optimize_existing_images.py.
+"""
+
+import functools
+import io
+import os
+
+import numpy as np
+from PIL import Image, features
+
+from image_manifest import atomic_output
+
+# Widths of the downscaled WebP copies emitted next to the full-size image. 650px is the
+# display width used by layouts/_default/_markup/render-image.html, 1300px is its 2x.
+DEFAULT_WIDTHS = (650, 1300)
+
+# Encoder effort per --profile. draft is Pillow's fastest setting, for previewing locally;
+# upgrade_images.py re-encodes draft outputs with the release settings before deploying.
+PROFILES = ('release', 'draft')
+WEBP_METHOD = {'release': 6, 'draft': 0}
+PNG_OPTIONS = {'release': {'optimize': True}, 'draft': {'compress_level': 1}}
+
+# Output formats, in the order render-image.html offers them to the browser. AVIF and WebP get
+# the whole width ladder on a white background; PNG is one full-size copy keeping transparency.
+FORMATS = ('avif', 'webp', 'png')
+DEFAULT_FORMATS = ('webp', 'png')
+AVIF_QUALITY = 60
+AVIF_SPEED = {'release': 6, 'draft': 10}
+
+# Default encoder settings passed to encode_for_web; part of the image manifest's cache key
+IMAGE_PARAMS = {'max_width': 1920, 'webp_quality': 85, 'png_optimize': True, 'widths': list(DEFAULT_WIDTHS), 'formats': list(DEFAULT_FORMATS)}
+
+# Decoding limits, applied to every worker process by configure_limits. Images over the pixel
+# cap, or whose decode is estimated to need more than the memory ceiling, are refused up front.
+DEFAULT_MAX_PIXELS = 200_000_000
+DEFAULT_MAX_MEMORY_MB = 1024
+_max_memory = DEFAULT_MAX_MEMORY_MB << 20
+Image.MAX_IMAGE_PIXELS = DEFAULT_MAX_PIXELS
+
+# Large images are decoded at a reduced scale (JPEG draft) or shrunk with reduce() down to
+# this multiple of the target size before the final LANCZOS pass, as Image.thumbnail does
+REDUCING_GAP = 2.0
+
+# Range of WebP qualities tried by the adaptive quality search
+QUALITY_RANGE = (30, 95)
+
+# SSIM is measured at display width, where most readers see the image
+SEARCH_WIDTH = 650
+SSIM_WINDOW = 8
+
+
+class ImageTooLarge(ValueError):
+    """Raised instead of decoding an image over the pixel cap or the memory ceiling."""
+
+
+def configure_limits(max_pixels=DEFAULT_MAX_PIXELS, max_memory_mb=DEFAULT_MAX_MEMORY_MB):
+    """Set the decoding limits of this process; used as the process pool initializer."""
+    global _max_memory
+    Image.MAX_IMAGE_PIXELS = max_pixels
+    _max_memory = max_memory_mb << 20
+
+
+def target_size(size, max_width):
+    """Size of an image of the given size once scaled down to at most max_width."""
+    width, height = size
+    if width <= max_width:
+        return size
+    return max_width, int(height * max_width / width)
+
+
+def reduce_factor(size, output_size):
+    """Integer factor for reduce() that keeps an image of size at least REDUCING_GAP times output_size."""
+    return max(1, int(size[0] / (output_size[0] * REDUCING_GAP)))
+
+
+def estimate_peak_bytes(decoded_size, mode, output_size):
+    """
+    Rough peak memory of encoding an image decoded at decoded_size: the decoded pixels, the
+    reduce()d copy, and the resized copy with its RGB flatten for the lossy formats.
+    """
+    bands = Image.getmodebands(mode)
+    factor = reduce_factor(decoded_size, output_size)
+    decoded = decoded_size[0] * decoded_size[1]
+    output = output_size[0] * output_size[1]
+    return (decoded + decoded // (factor * factor)) * bands + output * (bands + 3)
+
+
+def _reduce_in_strips(img, factor, rows=256):
+    """
+    img.reduce(factor), computed a strip of rows at a time. Pillow premultiplies RGBA and LA
+    images into a full-size copy before reducing them, which doubles the peak for big PNGs.
+    """
+    reduced = Image.new(img.mode, (-(-img.width // factor), -(-img.height // factor)))
+    step = factor * rows
+    for top in range(0, img.height, step):
+        reduced.paste(img.crop((0, top, img.width, min(top + step, img.height))).reduce(factor), (0, top // factor))
+    return reduced
+
+
+def load_for_web(src_path, max_width):
+    """
+    Decode src_path scaled down to at most max_width, holding as few full-size buffers as
+    possible: JPEGs are decoded at a reduced DCT scale, other formats are shrunk with
+    reduce() before LANCZOS, and the decoded image is released once it has been resized.
+    Raises ImageTooLarge before decoding anything over the pixel cap or the memory ceiling.
+
+    Returns: (image, original (width, height))
+    """
+    try:
+        img = Image.open(src_path)
+    except Image.DecompressionBombError as e:
+        # Pillow refuses to open anything over twice its cap before the check below can run
+        raise ImageTooLarge(str(e)) from e
+    with img:
+        original_size = img.size
+        if original_size[0] * original_size[1] > Image.MAX_IMAGE_PIXELS:
+            raise ImageTooLarge(f"{original_size[0]}x{original_size[1]} is over the {Image.MAX_IMAGE_PIXELS} pixel cap")
+        size = target_size(original_size, max_width)
+        if size != original_size:
+            img.draft(img.mode, (int(size[0] * REDUCING_GAP), int(size[1] * REDUCING_GAP)))
+        peak = estimate_peak_bytes(img.size, img.mode, size)
+        if peak > _max_memory:
+            raise ImageTooLarge(f"decoding {original_size[0]}x{original_size[1]} needs ~{peak >> 20}MB, over the {_max_memory >> 20}MB ceiling")
+        img.load()
+        if img.size == size:
+            return img, original_size
+        factor = reduce_factor(img.size, size)
+        if factor > 1 and img.mode in ('L', 'LA', 'RGB', 'RGBA'):
+            img = _reduce_in_strips(img, factor)
+        return img.resize(size, Image.Resampling.LANCZOS), original_size
+
+
+def flatten(img):
+    """
+    RGB version of img for the lossy formats, on a white background if it has alpha.
+    img itself is returned when it is RGB already, instead of a copy.
+    """
+    if img.mode == 'RGB':
+        return img
+    if img.mode in ('RGBA', 'LA'):
+        flat = Image.new('RGB', img.size, (255, 255, 255))
+        if img.mode == 'RGBA':
+            # An RGBA mask uses its alpha band, without splitting off a copy of it
+            flat.paste(img, mask=img)
+        else:
+            flat.paste(img)
+        return flat
+    return img.convert('RGB')
+
+
+def ladder(width, widths, max_width):
+    """
+    Widths to encode for an image `width` px wide, largest first: the full size (capped at
+    max_width) followed by every rung of widths that is strictly narrower.
+    """
+    top = min(width, max_width)
+    return [top] + sorted((w for w in set(widths) if w < top), reverse=True)
+
+
+def downscale_chain(img, widths):
+    """
+    Yield (width, height, image) for each of widths (descending, all narrower than img),
+    resizing each rung from the previous one rather than from the full-size image, so the
+    source is decoded once and every step works on progressively fewer pixels.
+    """
+    for width in widths:
+        height = max(1, round(img.height * width / img.width))
+        img = img.resize((width, height), Image.Resampling.LANCZOS)
+        yield width, height, img
+
+
+def variant_name(base_name, width):
+    return f"{base_name}-{width}w"
+
+
+def link_format(formats):
+    """Format markdown links point at, which render-image.html also uses for the <img> fallback."""
+    return next(fmt for fmt in ('webp', 'png', 'avif') if fmt in formats)
+
+
+def unsupported_formats(formats):
+    """The lossy formats among formats that this Pillow build cannot encode (AVIF needs Pillow 11.3+)."""
+    return [fmt for fmt in formats if fmt != 'png' and not features.check(fmt)]
+
+
+def save_lossy(img, path, fmt, webp_quality, profile):
+    """Save an RGB image as AVIF or WebP with the encoder settings of profile."""
+    if fmt == 'avif':
+        img.save(path, 'AVIF', quality=AVIF_QUALITY, speed=AVIF_SPEED[profile])
+    else:
+        img.save(path, 'WEBP', quality=webp_quality, method=WEBP_METHOD[profile])
+
+
+def _luma(img):
+    return np.asarray(img.convert('L'), dtype=np.float64)
+
+
+def _box_mean(x, size):
+    """Mean over every size x size window of x, via a summed-area table."""
+    table = np.pad(x, ((1, 0), (1, 0))).cumsum(0).cumsum(1)
+    return (table[size:, size:] - table[:-size, size:] - table[size:, :-size] + table[:-size, :-size]) / (size * size)
+
+
+def ssim(a, b):
+    """Mean structural similarity of two equally sized images, on luma over sliding square windows."""
+    x, y = _luma(a), _luma(b)
+    size = min(SSIM_WINDOW, *x.shape)
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    mu_x, mu_y = _box_mean(x, size), _box_mean(y, size)
+    var_x = _box_mean(x * x, size) - mu_x ** 2
+    var_y = _box_mean(y * y, size) - mu_y ** 2
+    cov = _box_mean(x * y, size) - mu_x * mu_y
+    ssim_map = ((2 * mu_x * mu_y + c1) * (2 * cov + c2)) / ((mu_x ** 2 + mu_y ** 2 + c1) * (var_x + var_y + c2))
+    return float(ssim_map.mean())
+
+
+def encode_webp(img, quality):
+    """Encode img to WebP in memory, as encode_for_web does on disk."""
+    buffer = io.BytesIO()
+    img.save(buffer, 'WEBP', quality=quality, method=6)
+    return buffer.getvalue()
+
+
+def _bisect(low, high, accept):
+    """Smallest quality in [low, high] that accept()s, assuming acceptance is monotonic; high if none does."""
+    while low < high:
+        middle = (low + high) // 2
+        if accept(middle):
+            high = middle
+        else:
+            low = middle + 1
+    return high
+
+
+def choose_quality(img, webp_quality, ssim_target=None, max_bytes=None):
+    """
+    Pick the WebP quality for an RGB image:
+    - With ssim_target, the lowest quality in QUALITY_RANGE whose encode of img, downscaled to
+      SEARCH_WIDTH, reaches that SSIM against the unencoded pixels; otherwise webp_quality
+    - With max_bytes, lowered further to the highest quality whose full-size encode fits
+
+    Returns: (quality, SSIM of the choice at SEARCH_WIDTH or None)
+    """
+    low, high = QUALITY_RANGE
+    probe = img if img.width <= SEARCH_WIDTH else img.resize(
+        (SEARCH_WIDTH, max(1, round(img.height * SEARCH_WIDTH / img.width))), Image.Resampling.LANCZOS)
+
+    @functools.cache
+    def score(quality):
+        return ssim(probe, Image.open(io.BytesIO(encode_webp(probe, quality))))
+
+    @functools.cache
+    def size(quality):
+        return len(encode_webp(img, quality))
+
+    quality = webp_quality
+    if ssim_target is not None:
+        quality = _bisect(low, high, lambda q: score(q) >= ssim_target)
+
+    if max_bytes is not None and size(quality) > max_bytes:
+        # Highest quality within budget: bisect on "too large" and step back one
+        quality = max(low, _bisect(low, quality, lambda q: size(q) > max_bytes) - 1)
+
+    return quality, (round(score(quality), 4) if ssim_target is not None else None)
+
+
+def image_params(args):
+    """Encoder settings for encode_for_web as selected by the --widths, --formats, --ssim-target, --max-kb and --profile options."""
+    params = dict(IMAGE_PARAMS, widths=args.widths, formats=args.formats)
+    # Only present when enabled, so manifests written without them stay valid
+    if args.ssim_target is not None:
+        params['ssim_target'] = args.ssim_target
+    if args.max_kb is not None:
+        params['max_bytes'] = args.max_kb * 1024
+    if args.profile == 'draft':
+        params['profile'] = 'draft'
+    return params
+
+
+def encode_for_web(src_path, dst_dir, base_name, max_width=1920, webp_quality=85, png_optimize=True, widths=DEFAULT_WIDTHS,
+                   formats=DEFAULT_FORMATS, ssim_target=None, max_bytes=None, chosen_quality=None, profile='release'):
+    """
+    Encode src_path into dst_dir as base_name in every format listed:
+    - Resize if width > max_width, decoding within the limits set by configure_limits (see load_for_web)
+    - PNG is one full-size copy keeping transparency; AVIF and WebP are flattened onto white and get
+      base_name-<width>w copies for every entry of widths below the full size, downscaled progressively
+    - WebP uses webp_quality, or with ssim_target / max_bytes the quality picked by choose_quality;
+      chosen_quality reuses an earlier pick without searching
+    - With profile='draft', use the fastest encoder settings and skip the quality search
+    Every output is written through a temporary file and moved into place when complete.
+
+    Returns: dict with the original and full-size width/height, the formats written, the variants
+    (name/width/height, narrowest first), all output paths, the full-size output size per format,
+    and the WebP quality ("quality") if one was searched for or reused, with the SSIM of a search
+    Raises ImageTooLarge for images over the limits, and whatever Pillow raises for unreadable ones
+    """
+    img, (width, height) = load_for_web(src_path, max_width)
+    lossy = [fmt for fmt in formats if fmt != 'png']
+    outputs = []
+
+    # WebP compresses better without alpha channel, so flatten to white background
+    webp_img = flatten(img)
+
+    # PNG fallback preserves transparency for older browsers
+    if 'png' in formats:
+        png_path = os.path.join(dst_dir, base_name + '.png')
+        with atomic_output(png_path) as tmp_path:
+            if png_optimize:
+                img.save(tmp_path, 'PNG', **PNG_OPTIONS[profile])
+            else:
+                img.save(tmp_path, 'PNG')
+        outputs.append(png_path)
+    # Only the flattened copy is needed from here on
+    del img
+
+    info = {}
+    if chosen_quality is not None:
+        webp_quality = info['quality'] = chosen_quality
+    elif 'webp' in formats and (ssim_target is not None or max_bytes is not None) and profile == 'release':
+        webp_quality, info['ssim'] = choose_quality(webp_img, webp_quality, ssim_target, max_bytes)
+        info['quality'] = webp_quality
+
+    # Full size and responsive copies for srcset, in every lossy format
+    def save_rung(name, rung_img):
+        for fmt in lossy:
+            path = os.path.join(dst_dir, f'{name}.{fmt}')
+            with atomic_output(path) as tmp_path:
+                save_lossy(rung_img, tmp_path, fmt, webp_quality, profile)
+            outputs.append(path)
+
+    save_rung(base_name, webp_img)
+    variants = [{'name': base_name, 'width': webp_img.width, 'height': webp_img.height}]
+    for variant_width, variant_height, variant_img in downscale_chain(webp_img, ladder(webp_img.width, widths, max_width)[1:] if lossy else []):
+        name = variant_name(base_name, variant_width)
+        save_rung(name, variant_img)
+        variants.append({'name': name, 'width': variant_width, 'height': variant_height})
+
+    return {
+        'original_width': width,
+        'original_height': height,
+        'width': webp_img.width,
+        'height': webp_img.height,
+        'formats': list(formats),
+        'variants': variants[::-1],
+        'outputs': outputs,
+        'sizes': {fmt: os.path.getsize(os.path.join(dst_dir, f'{base_name}.{fmt}')) for fmt in formats},
+        **info,
+    }
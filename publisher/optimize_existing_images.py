@@ -4,82 +4,110 @@ Batch optimize all existing images in the Hugo static/images directory.
 This script processes existing images to WebP format with PNG fallback.
 """
 
+import argparse
 import os
 import shutil
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 from pathlib import Path
-from PIL import Image
 from datetime import datetime
+from image_manifest import DEFAULT_MANIFEST_PATH, ImageManifest
+from imaging import (DEFAULT_FORMATS, DEFAULT_MAX_MEMORY_MB, DEFAULT_MAX_PIXELS, DEFAULT_WIDTHS, FORMATS, IMAGE_PARAMS, PROFILES,
+                     configure_limits, encode_for_web, image_params, unsupported_formats)
 
 
-def optimize_image(src_path, dst_dir, base_name, max_width=1920, webp_quality=85, png_optimize=True):
+def optimize_image(src_path, dst_dir, base_name, **params):
     """
-    Optimize an image for web display:
-    - Resize if width > max_width (default 1920px for retina displays)
-    - Convert to WebP at specified quality (default 85%)
-    - Also save optimized PNG as fallback
-    - Maintains aspect ratio
+    Optimize an image for web display with imaging.encode_for_web (see there for params) and
+    work out the savings against the original. Failures are reported and leave the original in place.
 
-    Returns: tuple of (webp_path, png_path, stats_dict)
+    Returns: tuple of (webp_path, png_path, stats_dict), a path being None if its format is not written
     """
     try:
-        with Image.open(src_path) as img:
-            original_mode = img.mode
-            width, height = img.size
-            original_size = os.path.getsize(src_path)
-
-            resized = False
-            if width > max_width:
-                ratio = max_width / width
-                new_width = max_width
-                new_height = int(height * ratio)
-                img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                resized = True
-                resize_info = f"{width}x{height} → {new_width}x{new_height}"
-            else:
-                resize_info = f"{width}x{height} (no resize)"
-
-            webp_path = os.path.join(dst_dir, base_name + '.webp')
-            png_path = os.path.join(dst_dir, base_name + '.png')
-
-            # WebP compresses better without alpha channel, so flatten to white background
-            if original_mode in ('RGBA', 'LA'):
-                webp_img = Image.new('RGB', img.size, (255, 255, 255))
-                if img.mode == 'RGBA':
-                    webp_img.paste(img, mask=img.split()[3])
-                else:
-                    webp_img.paste(img)
-                webp_img.save(webp_path, 'WEBP', quality=webp_quality, method=6)
-            else:
-                rgb_img = img.convert('RGB')
-                rgb_img.save(webp_path, 'WEBP', quality=webp_quality, method=6)
-
-            # PNG fallback preserves transparency for older browsers
-            if png_optimize:
-                img.save(png_path, 'PNG', optimize=True)
-            else:
-                img.save(png_path, 'PNG')
-
-            webp_size = os.path.getsize(webp_path)
-            png_size = os.path.getsize(png_path)
-            savings = ((original_size - webp_size) / original_size) * 100
-
-            stats = {
-                'original_size': original_size,
-                'webp_size': webp_size,
-                'png_size': png_size,
-                'savings_percent': savings,
-                'resized': resized,
-                'resize_info': resize_info
-            }
+        original_size = os.path.getsize(src_path)
+        stats = encode_for_web(src_path, dst_dir, base_name, **params)
+        width, height = stats['original_width'], stats['original_height']
+        stats['resized'] = stats['width'] < width
+        if stats['resized']:
+            stats['resize_info'] = f"{width}x{height} → {stats['width']}x{stats['height']}"
+        else:
+            stats['resize_info'] = f"{width}x{height} (no resize)"
+        stats['original_size'] = original_size
+        stats['savings_percent'] = ((original_size - min(stats['sizes'].values())) / original_size) * 100
 
-            return webp_path, png_path, stats
+        webp_path = os.path.join(dst_dir, base_name + '.webp') if 'webp' in stats['formats'] else None
+        png_path = os.path.join(dst_dir, base_name + '.png') if 'png' in stats['formats'] else None
+        return webp_path, png_path, stats
 
     except Exception as e:
         print(f"  ❌ Error optimizing {src_path}: {str(e)}")
         return None, None, None
 
 
+def optimize_group(src_paths, dst_dir, params=IMAGE_PARAMS):
+    """
+    Worker entry point: optimize images sharing a base name one after another.
+    They write the same base_name.webp/png outputs, so they must not run concurrently.
+
+    Returns: list of optimize_image results, in the order of src_paths
+    """
+    return [optimize_image(src_path, dst_dir, Path(src_path).stem, **params) for src_path in src_paths]
+
+
+def optimize_in_order(groups, dst_dir, pool=None, params=IMAGE_PARAMS):
+    """
+    Optimize groups of images, on the process pool if one is given, yielding
+    (image_path, optimize_image result) pairs in input order as they become available.
+    A group whose worker dies is reported as failed without stopping the others.
+    """
+    if pool is None:
+        outcomes = [(files, None) for files in groups]
+    else:
+        outcomes = [(files, pool.submit(optimize_group, [str(f) for f in files], dst_dir, params)) for files in groups]
+
+    for files, future in outcomes:
+        try:
+            group_results = future.result() if future else optimize_group([str(f) for f in files], dst_dir, params)
+        except Exception as e:
+            print(f"  ❌ Error optimizing {', '.join(Path(f).name for f in files)}: {str(e)}")
+            group_results = [(None, None, None)] * len(files)
+        yield from zip(files, group_results)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Batch optimize all existing images in the Hugo static/images directory.")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="Number of worker processes used to encode images (default: number of CPU cores, 1 disables the pool)")
+    parser.add_argument("--manifest", default=DEFAULT_MANIFEST_PATH, help="Image manifest used to skip images that are already optimized (default: the Hugo data/images.json file)")
+    parser.add_argument("--force", action="store_true", help="Process every image, including ones the manifest records as already optimized")
+    parser.add_argument("--profile", choices=PROFILES, default="release", help="Encoder effort; draft uses the fastest settings and marks images as drafts for upgrade_images.py (default: release)")
+    parser.add_argument("--ssim-target", type=float, help="Pick the lowest WebP quality per image whose SSIM at display width reaches this target, e.g. 0.98 (default: fixed quality 85)")
+    parser.add_argument("--max-kb", type=int, help="Lower an image's WebP quality until the full-size WebP fits in this many KB (default: no budget)")
+    parser.add_argument("--formats", nargs="+", choices=FORMATS, default=list(DEFAULT_FORMATS), help=f"Image formats to write; render-image.html offers the ones present for each image (default: {' '.join(DEFAULT_FORMATS)})")
+    parser.add_argument("--widths", nargs="*", type=int, default=list(DEFAULT_WIDTHS), help=f"Widths of the downscaled WebP copies used for srcset (default: {' '.join(map(str, DEFAULT_WIDTHS))})")
+    parser.add_argument("--max-memory-mb", type=int, default=DEFAULT_MAX_MEMORY_MB, help=f"Estimated peak memory one worker may use to decode an image; larger images fail (default: {DEFAULT_MAX_MEMORY_MB})")
+    parser.add_argument("--max-pixels", type=int, default=DEFAULT_MAX_PIXELS, help=f"Images with more pixels fail instead of being decoded (default: {DEFAULT_MAX_PIXELS})")
+    args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error(f"--jobs must be at least 1, got {args.jobs}")
+    if any(width < 1 for width in args.widths):
+        parser.error("--widths must all be positive")
+    args.widths = sorted(set(args.widths))
+    args.formats = [fmt for fmt in FORMATS if fmt in args.formats]
+    unsupported = unsupported_formats(args.formats)
+    if unsupported:
+        parser.error(f"This Pillow build cannot encode {', '.join(unsupported)}, install Pillow>=11.3 or drop it from --formats")
+    if args.ssim_target is not None and not 0 < args.ssim_target <= 1:
+        parser.error(f"--ssim-target must be in (0, 1], got {args.ssim_target}")
+    if args.max_kb is not None and args.max_kb < 1:
+        parser.error(f"--max-kb must be at least 1, got {args.max_kb}")
+    if args.max_memory_mb < 1 or args.max_pixels < 1:
+        parser.error("--max-memory-mb and --max-pixels must be positive")
+    return args
+
+
 def main():
+    args = parse_args()
+
     # Configuration
     images_dir = Path('/home/akcube/akcube.github.io/static/images')
     backup_dir = images_dir / 'backup'
@@ -97,24 +125,41 @@ def main():
     else:
         print(f"\n✓ Backup directory exists: {backup_dir}")
 
+    params = image_params(args)
+    manifest = ImageManifest(args.manifest, str(images_dir), refresh=args.force)
+    evicted = manifest.prune()
+    if evicted:
+        print(f"✓ Evicted {len(evicted)} manifest entries whose outputs were deleted")
+
     # Find all image files
     image_extensions = {'.png', '.jpg', '.jpeg', '.webp', '.gif', '.bmp'}
     image_files = []
+    skipped = 0
 
     for file in images_dir.iterdir():
         if file.is_file() and file.suffix.lower() in image_extensions:
             # Skip if it's in the backup directory
             if 'backup' not in str(file):
+                # Skip outputs of an earlier run that have not changed since; width variants are
+                # never sources, not even with --force
+                if manifest.is_variant(str(file)) or (not args.force and manifest.is_output(str(file))):
+                    skipped += 1
+                    continue
                 image_files.append(file)
 
+    # Sort so that runs are reproducible and images sharing a base name end up adjacent
+    image_files.sort(key=lambda file: (file.stem, file.name))
+
     print(f"\n✓ Found {len(image_files)} images to process")
+    if skipped:
+        print(f"ℹ Skipping {skipped} images already optimized according to {args.manifest}")
 
     # Confirm before proceeding
     print("\n" + "=" * 80)
     print("WARNING: This will:")
     print("  1. Backup original images to static/images/backup/")
-    print("  2. Replace originals with optimized WebP + PNG versions")
-    print("  3. Images already optimized will be processed again")
+    print(f"  2. Replace originals with optimized {' + '.join(fmt.upper() for fmt in args.formats)} versions")
+    print("  3. Images already optimized (recorded in the image manifest) are left untouched")
     print("=" * 80)
 
     response = input("\nDo you want to proceed? (yes/no): ").strip().lower()
@@ -131,60 +176,79 @@ def main():
         'processed': 0,
         'failed': 0,
         'total_original_size': 0,
-        'total_webp_size': 0,
-        'total_png_size': 0,
+        'total_sizes': dict.fromkeys(args.formats, 0),
         'resized_count': 0
     }
 
-    for idx, img_file in enumerate(image_files, 1):
-        print(f"[{idx}/{len(image_files)}] Processing: {img_file.name}")
-
-        # Backup original
+    # Backup originals up front so workers only ever touch files that are safely copied
+    backup_notes = []
+    for img_file in image_files:
         backup_path = backup_dir / img_file.name
         if not backup_path.exists():
             shutil.copy2(img_file, backup_path)
-            print(f"  ✓ Backed up to: {backup_path.name}")
+            backup_notes.append(f"  ✓ Backed up to: {backup_path.name}")
         else:
-            print(f"  ℹ Already backed up: {backup_path.name}")
-
-        # Get base name without extension
-        base_name = img_file.stem
-
-        # Optimize
-        webp_path, png_path, stats = optimize_image(
-            str(img_file),
-            str(images_dir),
-            base_name
-        )
-
-        if stats:
-            print(f"  ✓ Original: {stats['original_size']//1024}KB")
-            print(f"  ✓ WebP: {stats['webp_size']//1024}KB ({stats['savings_percent']:.1f}% savings)")
-            print(f"  ✓ PNG: {stats['png_size']//1024}KB")
-            print(f"  ✓ Dimensions: {stats['resize_info']}")
-
-            # Delete original file only if it's not one of our newly created files
-            # The newly created files are: base_name.webp and base_name.png
-            newly_created = {f"{base_name}.webp", f"{base_name}.png"}
-            if img_file.name not in newly_created:
-                # This is the original file with a different extension (e.g., .jpg)
-                # Delete it since we've created optimized versions
-                try:
-                    img_file.unlink()
-                    print(f"  ✓ Removed original: {img_file.name}")
-                except FileNotFoundError:
-                    pass  # Already deleted or never existed
-
-            total_stats['processed'] += 1
-            total_stats['total_original_size'] += stats['original_size']
-            total_stats['total_webp_size'] += stats['webp_size']
-            total_stats['total_png_size'] += stats['png_size']
-            if stats['resized']:
-                total_stats['resized_count'] += 1
-        else:
-            total_stats['failed'] += 1
+            backup_notes.append(f"  ℹ Already backed up: {backup_path.name}")
+
+    # Identify sources before encoding: outputs may overwrite them (e.g. foo.png) and originals are deleted
+    sources = {img_file: manifest.source_key(img_file.stem, str(img_file)) for img_file in image_files}
+
+    # Images with the same base name form one job; jobs run on the pool, results come back in order
+    groups = {}
+    for img_file in image_files:
+        groups.setdefault(img_file.stem, []).append(img_file)
+
+    limits = (args.max_pixels, args.max_memory_mb)
+    configure_limits(*limits)
+    with ProcessPoolExecutor(max_workers=args.jobs, initializer=configure_limits, initargs=limits) if args.jobs > 1 else nullcontext() as pool:
+        results = optimize_in_order(list(groups.values()), str(images_dir), pool, params)
+        for idx, ((img_file, (webp_path, png_path, stats)), backup_note) in enumerate(zip(results, backup_notes), 1):
+            print(f"[{idx}/{len(image_files)}] Processing: {img_file.name}")
+            print(backup_note)
+
+            # Get base name without extension
+            base_name = img_file.stem
+
+            if stats:
+                print(f"  ✓ Original: {stats['original_size']//1024}KB")
+                for fmt, size in stats['sizes'].items():
+                    print(f"  ✓ {fmt.upper()}: {size//1024}KB")
+                print(f"  ✓ Savings: {stats['savings_percent']:.1f}%")
+                print(f"  ✓ Dimensions: {stats['resize_info']}")
+                if 'quality' in stats:
+                    print(f"  ✓ Quality: {stats['quality']}" + (f" (SSIM {stats['ssim']})" if stats.get('ssim') is not None else ""))
+                print(f"  ✓ Widths: {', '.join(str(variant['width']) for variant in stats['variants'])}")
+
+                # Delete original file only if it's not one of our newly created files
+                # The newly created files are base_name in every format and the width variants
+                newly_created = {os.path.basename(path) for path in stats['outputs']}
+                if img_file.name not in newly_created:
+                    # This is the original file with a different extension (e.g., .jpg)
+                    # Delete it since we've created optimized versions
+                    try:
+                        img_file.unlink()
+                        print(f"  ✓ Removed original: {img_file.name}")
+                    except FileNotFoundError:
+                        pass  # Already deleted or never existed
+
+                details = {key: stats[key] for key in ('width', 'height', 'formats', 'variants', 'quality') if key in stats}
+                if args.profile == 'draft':
+                    # The original is gone, so drafts are upgraded from the backup copy
+                    details['source_path'] = str(backup_dir / img_file.name)
+                manifest.record(base_name, sources[img_file], params, stats['outputs'], **details)
+
+                total_stats['processed'] += 1
+                total_stats['total_original_size'] += stats['original_size']
+                for fmt, size in stats['sizes'].items():
+                    total_stats['total_sizes'][fmt] += size
+                if stats['resized']:
+                    total_stats['resized_count'] += 1
+            else:
+                total_stats['failed'] += 1
+
+            print()
 
-        print()
+    manifest.save()
 
     # Print summary
     print("=" * 80)
@@ -195,15 +259,13 @@ def main():
     print(f"↕ Resized: {total_stats['resized_count']} images")
     print(f"\nStorage:")
     print(f"  Original total: {total_stats['total_original_size']//1024//1024}MB ({total_stats['total_original_size']//1024}KB)")
-    print(f"  WebP total: {total_stats['total_webp_size']//1024//1024}MB ({total_stats['total_webp_size']//1024}KB)")
-    print(f"  PNG total: {total_stats['total_png_size']//1024//1024}MB ({total_stats['total_png_size']//1024}KB)")
+    for fmt, size in total_stats['total_sizes'].items():
+        print(f"  {fmt.upper()} total: {size//1024//1024}MB ({size//1024}KB)")
 
     if total_stats['total_original_size'] > 0:
-        webp_savings = ((total_stats['total_original_size'] - total_stats['total_webp_size']) / total_stats['total_original_size']) * 100
-        png_savings = ((total_stats['total_original_size'] - total_stats['total_png_size']) / total_stats['total_original_size']) * 100
         print(f"\nSavings:")
-        print(f"  WebP: {webp_savings:.1f}% reduction")
-        print(f"  PNG: {png_savings:.1f}% reduction")
+        for fmt, size in total_stats['total_sizes'].items():
+            print(f"  {fmt.upper()}: {((total_stats['total_original_size'] - size) / total_stats['total_original_size']) * 100:.1f}% reduction")
 
     print("\n" + "=" * 80)
     print("✓ Optimization complete!")
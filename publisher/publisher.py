@@ -1,23 +1,71 @@
 import argparse
+import contextlib
 import datetime
 import git
 import inflection
+import io
+import json
 import os
 import pytz
 import re
 import shlex
 import shutil
+import signal
+import time
 import yaml
 import titlecase
-from PIL import Image
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from imaging import (DEFAULT_FORMATS, DEFAULT_MAX_MEMORY_MB, DEFAULT_MAX_PIXELS, DEFAULT_WIDTHS, FORMATS, IMAGE_PARAMS, PROFILES, ImageTooLarge,
+	configure_limits, encode_for_web, image_params, link_format, unsupported_formats)
+from image_manifest import DEFAULT_MANIFEST_PATH, ImageManifest, atomic_output, hash_file, write_json_atomic
 from pathlib import Path
+from search_index import build_search_index
+
+# Local, machine-specific caches that are never committed
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache')
+DEFAULT_INDEX_CACHE_PATH = os.path.join(CACHE_DIR, 'image-index.json')
+DEFAULT_DATES_CACHE_PATH = os.path.join(CACHE_DIR, 'creation-dates.json')
+DEFAULT_SYNC_STATE_PATH = os.path.join(CACHE_DIR, 'vault-sync.json')
+DEFAULT_SEARCH_CACHE_PATH = os.path.join(CACHE_DIR, 'search-pages.json')
+
+SITE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_LINK_INDEX_PATH = os.path.join(SITE_DIR, 'assets', 'indices', 'linkIndex.json')
+DEFAULT_SEARCH_INDEX_DIR = os.path.join(SITE_DIR, 'assets', 'indices', 'search')
+
+# Obsidian embeds (![[image.png]]) and wikilinks ([[Note]]) rewritten by rewrite_links
+IMAGE_EMBED = re.compile(r'!\[\[(.*?)\]\]')
+WIKILINK = re.compile(r'\[\[(.*?)\]\]')
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Preprocess Obsidian-generated Markdown files for compatibility with the customized TeXify3 Hugo theme by converting 'tags' YAML to 'topics' and appending file creation & publishing date metadata to the YAML header.")
     parser.add_argument("--dest", help="Destination directory | Usually the Hugo content/blog directory.", required=True)
     parser.add_argument("--idest", help="Destination directory to place compressed images | Usually the Hugo static/images directory.", required=True)
     parser.add_argument("--imgdirs", nargs="+", help="Source directories to get image files from.", required=True)
-    parser.add_argument("--source", nargs="+", help="Source markdown files.", required=True)
+    sources = parser.add_mutually_exclusive_group(required=True)
+    sources.add_argument("--source", nargs="+", help="Source markdown files.")
+    sources.add_argument("--vault", help="Sync every note in this directory, republishing only notes changed since the last sync and removing outputs of deleted notes.")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="Number of worker processes used to encode images | Defaults to the number of CPU cores, 1 disables the pool.")
+    parser.add_argument("--manifest", default=DEFAULT_MANIFEST_PATH, help="Image manifest used to skip re-encoding unchanged images | Defaults to the Hugo data/images.json file.")
+    parser.add_argument("--force", action="store_true", help="Re-encode every image even if the manifest says its outputs are up to date.")
+    parser.add_argument("--fingerprint", action="store_true", help="Name images <name>.<hash>.webp/png after their content so /images/* can be cached immutably, and delete superseded fingerprints no page references anymore.")
+    parser.add_argument("--profile", choices=PROFILES, default='release', help="Encoder effort. draft uses the fastest WebP/PNG settings for previewing and marks the images as drafts in the manifest; run upgrade_images.py to re-encode them before deploying | Defaults to release.")
+    parser.add_argument("--ssim-target", type=float, help="Pick the lowest WebP quality per image whose SSIM at display width reaches this target (e.g. 0.98) instead of a fixed 85 | Defaults to off.")
+    parser.add_argument("--max-kb", type=int, help="Lower an image's WebP quality until the full-size WebP fits in this many KB | Defaults to no budget.")
+    parser.add_argument("--formats", nargs="+", choices=FORMATS, default=list(DEFAULT_FORMATS), help=f"Image formats to write; render-image.html offers the ones present for each image, best first | Defaults to {' '.join(DEFAULT_FORMATS)}.")
+    parser.add_argument("--widths", nargs="*", type=int, default=list(DEFAULT_WIDTHS), help=f"Widths of the downscaled WebP copies used for srcset, next to the full-size image | Defaults to {' '.join(map(str, DEFAULT_WIDTHS))}.")
+    parser.add_argument("--max-memory-mb", type=int, default=DEFAULT_MAX_MEMORY_MB, help=f"Estimated peak memory one worker may use to decode an image; larger images are skipped with a warning | Defaults to {DEFAULT_MAX_MEMORY_MB}.")
+    parser.add_argument("--max-pixels", type=int, default=DEFAULT_MAX_PIXELS, help=f"Images with more pixels are skipped with a warning instead of decoded | Defaults to {DEFAULT_MAX_PIXELS}.")
+    parser.add_argument("--dates-cache", default=DEFAULT_DATES_CACHE_PATH, help=f"Cache of git creation dates, refreshed incrementally from the commits made since the last run | Defaults to {DEFAULT_DATES_CACHE_PATH}.")
+    parser.add_argument("--sync-state", default=DEFAULT_SYNC_STATE_PATH, help=f"State of previous --vault syncs | Defaults to {DEFAULT_SYNC_STATE_PATH}.")
+    parser.add_argument("--link-index", default=DEFAULT_LINK_INDEX_PATH, help=f"Link graph index patched with the edges of every published note | Defaults to {DEFAULT_LINK_INDEX_PATH}, pass an empty string to disable.")
+    parser.add_argument("--search-index", default=DEFAULT_SEARCH_INDEX_DIR, help=f"Directory for the compact sharded search index, rebuilt from the pages in the parent of --dest | Defaults to {DEFAULT_SEARCH_INDEX_DIR}, pass an empty string to disable.")
+    parser.add_argument("--search-cache", default=DEFAULT_SEARCH_CACHE_PATH, help=f"Terms of every indexed page, keyed by its size and mtime, so only changed pages are tokenized again | Defaults to {DEFAULT_SEARCH_CACHE_PATH}.")
+    parser.add_argument("--watch", action="store_true", help="Stay resident after publishing and republish notes as they or their images change.")
+    parser.add_argument("--interval", type=float, default=0.5, help="Seconds between polls in --watch mode.")
+    parser.add_argument("--debounce", type=float, default=1.0, help="Seconds without further changes before --watch republishes, so bursts of autosaves publish once.")
+    parser.add_argument("--index-cache", nargs="?", const=DEFAULT_INDEX_CACHE_PATH, default=None, help=f"Cache the image directory index on disk and reuse it while no directory has changed | Defaults to {DEFAULT_INDEX_CACHE_PATH} when given without a path.")
     args = parser.parse_args()
     
     if not os.path.isdir(args.dest):
@@ -26,91 +74,381 @@ def parse_args():
     if not os.path.isdir(args.idest):
     	parser.error(f'The images destination directory "{args.idest}" is not a valid directory.')
 
+    if args.jobs < 1:
+    	parser.error(f'--jobs must be at least 1, got {args.jobs}.')
+
+    if any(width < 1 for width in args.widths):
+    	parser.error('--widths must all be positive.')
+    args.widths = sorted(set(args.widths))
+    args.formats = [fmt for fmt in FORMATS if fmt in args.formats]
+    unsupported = unsupported_formats(args.formats)
+    if unsupported:
+    	parser.error(f'This Pillow build cannot encode {", ".join(unsupported)}, install Pillow>=11.3 or drop it from --formats.')
+
+    if args.ssim_target is not None and not 0 < args.ssim_target <= 1:
+    	parser.error(f'--ssim-target must be in (0, 1], got {args.ssim_target}.')
+
+    if args.max_kb is not None and args.max_kb < 1:
+    	parser.error(f'--max-kb must be at least 1, got {args.max_kb}.')
+
+    if args.max_memory_mb < 1 or args.max_pixels < 1:
+    	parser.error('--max-memory-mb and --max-pixels must be positive.')
+
+    if args.interval <= 0 or args.debounce < 0:
+    	parser.error('--interval must be positive and --debounce must not be negative.')
+
+    if args.vault and not os.path.isdir(args.vault):
+    	parser.error(f'The vault directory "{args.vault}" is not a valid directory.')
+
     is_markdown_file = lambda file_path: os.path.isfile(file_path) and file_path.endswith('.md')
-    invalid_sources = [src_path for src_path in args.source if not is_markdown_file(src_path)]
+    invalid_sources = [src_path for src_path in args.source or [] if not is_markdown_file(src_path)]
     if invalid_sources:
     	parser.error(f'The following files are not valid Markdown files:\n{"\n".join(invalid_sources)}')
     invalid_idirs = [src_dir for src_dir in args.imgdirs if not os.path.isdir(src_dir)]
     if invalid_idirs:
     	parser.error(f'The following source directories are not valid:\n{"\n".join(invalid_idirs)}')
 
-    return args.source, args.dest, args.imgdirs, args.idest
+    return args
+
+def read_json(path):
+	"""Contents of a JSON cache file, or an empty dict if it is missing or unreadable."""
+	try:
+		with open(path) as file:
+			return json.load(file)
+	except (OSError, ValueError):
+		return {}
+
+def _local_ctime(file_path):
+	local_timezone = datetime.datetime.now(datetime.timezone.utc).astimezone().tzinfo
+	dt = datetime.datetime.fromtimestamp(os.path.getctime(file_path))
+	# Whole seconds, like the git author dates, so the front matter looks the same either way
+	return dt.replace(tzinfo=local_timezone, microsecond=0)
+
+class CreationDateResolver:
+	"""
+	Resolve the creation date of many files with one history walk per git repository.
+	The history is walked oldest commit first, following renames, to map every path that
+	ever existed to the author date of the first commit in its lineage (the same commit
+	`git log --follow` lists last). With cache_path, the map is stored keyed by the HEAD it
+	was built at, so later runs only scan commits made since.
+	Files that are untracked, uncommitted or outside a repository fall back to their ctime.
+	"""
+
+	def __init__(self, cache_path=None):
+		self.cache_path = cache_path
+		self.cache = read_json(cache_path) if cache_path else {}
+		self.repos = {}
+
+	def _repo(self, directory):
+		if directory not in self.repos:
+			try:
+				self.repos[directory] = git.Repo(directory, search_parent_directories=True)
+			except (git.InvalidGitRepositoryError, git.NoSuchPathError):
+				self.repos[directory] = None
+		return self.repos[directory]
+
+	def _dates(self, repo):
+		"""Path (relative to the work tree) -> ISO author date of its first commit, current as of HEAD."""
+		try:
+			head = repo.head.commit.hexsha
+		except ValueError:
+			return {}  # No commits yet
+		entry = self.cache.get(repo.working_tree_dir)
+		if entry and entry['head'] == head:
+			return entry['dates']
+		try:
+			incremental = entry is not None and repo.is_ancestor(entry['head'], head)
+		except git.GitCommandError:
+			# The cached HEAD no longer exists (amended or rebased away and collected, or a fresh clone)
+			incremental = False
+		if incremental:
+			dates, rev = entry['dates'], f"{entry['head']}..{head}"
+		else:
+			dates, rev = {}, head
+
+		log = repo.git.execute(['git', '-c', 'core.quotepath=off', 'log', '--reverse', '-M', '--name-status', '--format=%x00%aI', rev])
+		date = None
+		for line in log.splitlines():
+			if line.startswith('\0'):
+				date = line[1:]
+				continue
+			fields = line.split('\t')
+			status = fields[0][:1]
+			if status == 'R':
+				old, new = fields[1], fields[2]
+				dates[new] = dates.get(old) or dates.get(new) or date
+			elif status in ('A', 'M', 'C', 'T'):
+				dates.setdefault(fields[-1], date)
+
+		self.cache[repo.working_tree_dir] = {'head': head, 'dates': dates}
+		return dates
+
+	def resolve(self, file_paths):
+		"""
+		Returns: dict of file path (as given) -> timezone-aware creation datetime
+		"""
+		result = {}
+		for file_path in file_paths:
+			real_path = os.path.realpath(file_path)
+			repo = self._repo(os.path.dirname(real_path))
+			date = None
+			if repo is not None:
+				relative_path = os.path.relpath(real_path, os.path.realpath(repo.working_tree_dir)).replace(os.sep, '/')
+				date = self._dates(repo).get(relative_path)
+			result[file_path] = datetime.datetime.fromisoformat(date) if date else _local_ctime(file_path)
+		return result
+
+	def save(self):
+		if self.cache_path and self.cache:
+			os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+			write_json_atomic(self.cache_path, self.cache)
 
 def get_date_of_creation(file_path):
-	file_path = os.path.abspath(file_path)
-	repo = git.Repo(file_path, search_parent_directories=True)
-	log = repo.git.log("--follow", "--format=%ad", "--", file_path)
-	if not log:
-		local_timezone = datetime.datetime.now(datetime.timezone.utc).astimezone().tzinfo
-		dt = datetime.datetime.fromtimestamp(os.path.getctime(file_path))
-		return dt.replace(tzinfo=local_timezone).strftime('%Y-%m-%d %H:%M:%S%z')
-	else:
-		return datetime.datetime.strptime(log.split('\n')[-1], '%a %b %d %H:%M:%S %Y %z')
-
-def optimize_image(src_path, dst_dir, base_name, max_width=1920, webp_quality=85, png_optimize=True):
-	"""
-	Optimize an image for web display:
-	- Resize if width > max_width (default 1920px for retina displays)
-	- Convert to WebP at specified quality (default 85%)
-	- Also save optimized PNG as fallback
-	- Maintains aspect ratio
-
-	Returns: tuple of (webp_path, png_path)
+	return CreationDateResolver().resolve([file_path])[file_path]
+
+class LinkIndex:
 	"""
-	try:
-		with Image.open(src_path) as img:
-			original_mode = img.mode
-			width, height = img.size
-
-			if width > max_width:
-				ratio = max_width / width
-				new_width = max_width
-				new_height = int(height * ratio)
-				img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-				print(f"  Resized {os.path.basename(src_path)} from {width}x{height} to {new_width}x{new_height}")
-
-			webp_path = os.path.join(dst_dir, base_name + '.webp')
-			png_path = os.path.join(dst_dir, base_name + '.png')
-
-			# WebP compresses better without alpha channel, so flatten to white background
-			if original_mode in ('RGBA', 'LA'):
-				webp_img = Image.new('RGB', img.size, (255, 255, 255))
-				if img.mode == 'RGBA':
-					webp_img.paste(img, mask=img.split()[3])
-				else:
-					webp_img.paste(img)
-				webp_img.save(webp_path, 'WEBP', quality=webp_quality, method=6)
-			else:
-				rgb_img = img.convert('RGB')
-				rgb_img.save(webp_path, 'WEBP', quality=webp_quality, method=6)
+	Link graph read by the theme's graph.js, in the layout hugo-obsidian writes to linkIndex.json:
+		{"index": {"links": {source: [edge, ...]}, "backlinks": {target: [edge, ...]}}, "links": [edge, ...]}
+	where every edge is {"source": "/blog/<slug>", "target": "/blog/<slug>", "text": <link text>}.
+	Publishing a note replaces only that note's outgoing edges and the backlinks they touch.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		index = read_json(path).get('index', {})
+		self.links = index.get('links', {})
+		self.backlinks = index.get('backlinks', {})
+		self.dirty = False
 
-			# PNG fallback preserves transparency for older browsers
-			if png_optimize:
-				img.save(png_path, 'PNG', optimize=True)
+	def update(self, source, edges):
+		"""Replace the outgoing edges of source; an empty list removes the page from the graph."""
+		old_edges = self.links.get(source, [])
+		if old_edges == edges:
+			return
+		for target in {edge['target'] for edge in old_edges} | {edge['target'] for edge in edges}:
+			incoming = [edge for edge in self.backlinks.get(target, []) if edge['source'] != source]
+			incoming += [edge for edge in edges if edge['target'] == target]
+			incoming.sort(key=lambda edge: edge['source'])
+			if incoming:
+				self.backlinks[target] = incoming
 			else:
-				img.save(png_path, 'PNG')
+				self.backlinks.pop(target, None)
+		if edges:
+			self.links[source] = edges
+		else:
+			self.links.pop(source, None)
+		self.dirty = True
+
+	def save(self):
+		if not self.dirty:
+			return
+		data = {
+			'index': {'links': self.links, 'backlinks': self.backlinks},
+			'links': [edge for source in sorted(self.links) for edge in self.links[source]],
+		}
+		with atomic_output(self.path) as tmp_path:
+			with open(tmp_path, 'w') as file:
+				json.dump(data, file, indent=2, sort_keys=True, ensure_ascii=False)
+		self.dirty = False
+
+def build_image_index(img_dirs, cache_path=None, dirs=None):
+	"""
+	Index every file under img_dirs by file name in a single scan.
+	Directories listed earlier in img_dirs take precedence, and within one directory tree
+	paths are ordered by a sorted walk, so the first path for a name is the one to use.
+	With cache_path, the index is stored together with the mtime of every scanned directory
+	and reused as long as none of them changed (adding, removing or renaming a file changes
+	the mtime of its parent directory). If dirs is given, it is filled with the mtime of every
+	directory the index covers, which is what --watch polls to notice new images.
+
+	Returns: dict of file name -> list of matching paths, in precedence order
+	"""
+	roots = [os.path.abspath(d) for d in img_dirs]
+	if cache_path and os.path.exists(cache_path):
+		try:
+			with open(cache_path) as file:
+				cached = json.load(file)
+			if cached['roots'] == roots and all(os.stat(d).st_mtime_ns == mtime for d, mtime in cached['dirs'].items()):
+				if dirs is not None:
+					dirs.update(cached['dirs'])
+				return cached['files']
+		except (OSError, ValueError, KeyError):
+			pass
+
+	files = {}
+	dirs = {} if dirs is None else dirs
+	for root_dir in roots:
+		for root, dirnames, filenames in os.walk(root_dir):
+			dirnames.sort()
+			dirs[root] = os.stat(root).st_mtime_ns
+			for name in sorted(filenames):
+				files.setdefault(name, []).append(os.path.join(root, name))
+
+	if cache_path:
+		os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+		write_json_atomic(cache_path, {'roots': roots, 'dirs': dirs, 'files': files})
+	return files
+
+def optimize_image(src_path, dst_dir, base_name, **params):
+	"""
+	Encode an image for web display with imaging.encode_for_web (see there for params), logging
+	the resize, the WebP quality searched for and the savings. An image that cannot be encoded is
+	copied through unchanged instead, so the page still shows it.
+
+	Returns: tuple of (webp_path, png_path, info) where info is the dict returned by encode_for_web,
+	or None for a fallback copy. webp_path and png_path are None when that format is not written;
+	all three are None for an image over the limits.
+	"""
+	try:
+		info = encode_for_web(src_path, dst_dir, base_name, **params)
+		formats = info['formats']
+		if info['width'] < info['original_width']:
+			print(f"  Resized {os.path.basename(src_path)} from {info['original_width']}x{info['original_height']} to {info['width']}x{info['height']}")
+		if 'ssim' in info:
+			print(f"  Chose WebP quality {info['quality']} for {os.path.basename(src_path)}" + (f" (SSIM {info['ssim']})" if info['ssim'] is not None else ""))
 
-			original_size = os.path.getsize(src_path)
-			webp_size = os.path.getsize(webp_path)
-			png_size = os.path.getsize(png_path)
-			savings = ((original_size - webp_size) / original_size) * 100
+		original_size = os.path.getsize(src_path)
+		sizes = info['sizes']
+		savings = ((original_size - min(sizes.values())) / original_size) * 100
+		print(f"  Optimized {os.path.basename(src_path)}: {original_size//1024}KB → {', '.join(f'{fmt.upper()}: {size//1024}KB' for fmt, size in sizes.items())} ({savings:.1f}% savings), widths: {', '.join(str(v['width']) for v in reversed(info['variants']))}")
 
-			print(f"  Optimized {os.path.basename(src_path)}: {original_size//1024}KB → WebP: {webp_size//1024}KB, PNG: {png_size//1024}KB ({savings:.1f}% savings)")
+		webp_path = os.path.join(dst_dir, base_name + '.webp') if 'webp' in formats else None
+		png_path = os.path.join(dst_dir, base_name + '.png') if 'png' in formats else None
+		return webp_path, png_path, info
 
-			return webp_path, png_path
+	except ImageTooLarge as e:
+		# Copying the source through would publish it at full size, so leave it out instead
+		print(f"  Warning: Skipping {src_path}: {str(e)}")
+		return None, None, None
 
 	except Exception as e:
 		print(f"  Warning: Could not optimize {src_path}: {str(e)}")
 		print(f"  Falling back to simple copy")
 		fallback_path = os.path.join(dst_dir, base_name + os.path.splitext(src_path)[1])
-		shutil.copy2(src_path, fallback_path)
-		return fallback_path, fallback_path
+		with atomic_output(fallback_path) as tmp_path:
+			shutil.copy2(src_path, tmp_path)
+		return fallback_path, fallback_path, None
+
+def _optimize_job(job):
+	"""
+	Worker entry point: run optimize_image for one (src_path, dst_dir, base_name, params) job
+	and hand its log lines back to the caller instead of interleaving them on stdout.
+	"""
+	src_path, dst_dir, base_name, params = job
+	log = io.StringIO()
+	with contextlib.redirect_stdout(log):
+		result = optimize_image(src_path, dst_dir, base_name, **params)
+	return result, log.getvalue()
+
+def submit_images(jobs, pool=None, manifest=None, pending=None):
+	"""
+	Start a batch of (src_path, dst_dir, base_name, params) jobs on the process pool if one is given,
+	without waiting for them, so the jobs of several notes can be queued before any is collected.
+	With a manifest, images whose source and encoder settings are unchanged are skipped and a WebP
+	quality searched for earlier is reused. Jobs are added to pending (base_name -> outcome, in
+	submission order), and a base name already in pending is not submitted twice.
+
+	Returns: pending, to be passed to collect_images
+	"""
+	pending = {} if pending is None else pending
+	for job in jobs:
+		src_path, _, base_name, params = job
+		if base_name in pending:
+			continue
+		source = manifest.source_key(base_name, src_path) if manifest else None
+		if manifest and manifest.lookup(base_name, source, params):
+			print(f"  Unchanged {os.path.basename(src_path)}, skipping")
+			pending[base_name] = (job, source, None, True)
+			continue
+		chosen_quality = manifest.chosen_quality(base_name, source, params) if manifest else None
+		if chosen_quality is not None:
+			job = (src_path, job[1], base_name, dict(params, chosen_quality=chosen_quality))
+		pending[base_name] = (job, source, pool.submit(_optimize_job, job) if pool else None, False)
+	return pending
+
+def collect_images(pending, manifest=None):
+	"""
+	Wait for the jobs started by submit_images (running them here if no pool was given) and record
+	the fresh encodes in the manifest. Results and logs are reported in submission order, so output
+	does not depend on scheduling, and a failing image is reported without aborting the rest.
+
+	Returns: list of optimize_image results (None for images that failed or were skipped)
+	"""
+	results = []
+	for job, source, future, cached in pending.values():
+		if cached:
+			results.append(None)
+			continue
+		try:
+			result, log = future.result() if future else _optimize_job(job)
+		except BrokenProcessPool:
+			# A worker died, e.g. killed for running out of memory, and took the whole pool with it
+			raise
+		except Exception as e:
+			print(f"  Warning: Could not optimize {job[0]}: {str(e)}")
+			result, log = None, ''
+		print(log, end='')
+		src_path, dst_dir, base_name, params = job
+		params = {key: value for key, value in params.items() if key != 'chosen_quality'}
+		# Fallback copies are not recorded, so they are retried on the next run
+		if manifest and result and result[2]:
+			info = result[2]
+			details = {key: info[key] for key in ('width', 'height', 'formats', 'variants', 'quality') if key in info}
+			if params.get('profile') == 'draft':
+				# Recorded so upgrade_images.py can re-encode it without the image directories
+				details['source_path'] = os.path.abspath(src_path)
+			manifest.record(base_name, source, params, info['outputs'], **details)
+		results.append(result)
+	return results
+
+def optimize_images(jobs, pool=None, manifest=None):
+	"""
+	Optimize a batch of (src_path, dst_dir, base_name, params) jobs, on the process pool if one is given,
+	and wait for all of them; see submit_images and collect_images.
 
-def process_file(src_path, dst_dir, img_dirs, idst_dir):
+	Returns: list of optimize_image results (None for images that failed or were skipped)
+	"""
+	return collect_images(submit_images(jobs, pool, manifest), manifest)
+
+def split_yaml_header(content):
+	"""Split a note into its YAML header (empty if it has none) and body."""
+	return ("", content) if content[0:3] != '---' else content.split('---\n', 2)[1:]
+
+def rewrite_links(content, page, output_names, formats):
+	"""
+	Turn the Obsidian image embeds and wikilinks of page's markdown into Hugo links. Embeds link
+	/images/<output name>.<format>, looked up in output_names by their parameterized file name.
+
+	Returns: (rewritten content, list of link graph edges from page)
+	"""
+	edges = []
+
+	def handle_wikilink(name):
+		edges.append({'source': page, 'target': f'/blog/{inflection.parameterize(name)}', 'text': name})
+		return f'[{name}](/blog/{inflection.parameterize(name)})'
+
+	def handle_image(name):
+		basename, ext = os.path.splitext(os.path.basename(name))
+		# Reference .webp (or the best other format written) in markdown; the Hugo render hook offers the rest
+		return f'![{basename}](/images/{output_names[inflection.parameterize(basename)]}.{link_format(formats)})\n'
+
+	content = IMAGE_EMBED.sub(lambda match: handle_image(match.group(1)), content)
+	content = WIKILINK.sub(lambda match: handle_wikilink(match.group(1)), content)
+	return content, edges
+
+def process_file(src_path, dst_dir, image_index, idst_dir, pool=None, manifest=None, dates=None, links=None, params=IMAGE_PARAMS, pending=None):
+	"""
+	Publish one note and encode the images it embeds. With pending, the image jobs are only
+	submitted into it (see submit_images) and the caller collects them after its last note,
+	so the pool works on the images of several notes at once.
+
+	Returns: {'output': markdown path, 'images': base name -> image source path}, or None on error
+	"""
 	try:
-		# Declare useful util fns / metadata
-		split_yaml_header = lambda content: ("", content) if content[0:3] != '---' else content.split('---\n', 2)[1:]
+		# Declare useful metadata
 		filename = os.path.splitext(os.path.basename(src_path))[0]
+		page = f'/blog/{inflection.parameterize(filename)}'
 		image_deps = set()
 
 		# Read & Parse source file
@@ -123,55 +461,318 @@ def process_file(src_path, dst_dir, img_dirs, idst_dir):
 		header['topics'] = header.pop('tags') if 'tags' in header else []
 		if 'date' not in header:
 			header['date'] = datetime.datetime.now(datetime.timezone.utc).astimezone().strftime('%Y-%m-%d %H:%M:%S%z')
-		header['doc'] = get_date_of_creation(src_path)
+		header['doc'] = dates.resolve([src_path])[src_path] if dates else get_date_of_creation(src_path)
 		header['title'] = titlecase.titlecase(filename).replace(';', ':')
 		header['author'] = 'Kishore Kumar'
 
-		# Parse & construct updated contents
-		def handle_wikilink(name):
-			return f'[{name}](/blog/{inflection.parameterize(name)})'
-
-		def handle_image(name, deps):
-			deps.add(name)
-			basename, ext = os.path.splitext(os.path.basename(name))
-			# Reference .webp in markdown (Hugo render hook will handle fallback)
-			return f'![{basename}](/images/{inflection.parameterize(basename)}.webp)\n'
-
-		content = re.sub(r'!\[\[(.*?)\]\]', lambda match: handle_image(match.group(1), image_deps), content)	
-		content = re.sub(r'\[\[(.*?)\]\]', lambda match: handle_wikilink(match.group(1)), content)
+		image_deps.update(IMAGE_EMBED.findall(content))
 
 		# Sync images folder with unsatisfied dependencies and compress
+		missing = sorted(name for name in image_deps if name not in image_index)
+		if missing:
+			raise ValueError(f'Given source directories for image files do not contain the following required image dependencies:\n{"\n".join(missing)}')
+
 		image_src_paths = []
-		for d in img_dirs:
-			satisfied = set()
-			for root, _, files in os.walk(d):
-				for imgname in image_deps:
-					if imgname in files:
-						satisfied.add(imgname)
-						image_src_paths.append(os.path.join(root, imgname))
-			image_deps = image_deps - satisfied
-		
-		if image_deps:
-			raise ValueError(f'Given source directories for image files do not contain the following required image dependencies:\n{"\n".join(image_deps)}')
+		for imgname in sorted(image_deps):
+			matches = image_index[imgname]
+			if len(matches) > 1:
+				print(f"  Warning: {imgname} exists in several image directories, using {matches[0]} (also found: {', '.join(matches[1:])})")
+			image_src_paths.append(matches[0])
 
+		# Key jobs by output name so two workers never write the same file; the last match wins
+		jobs = {}
 		for img in image_src_paths:
 			imgname, ext = os.path.splitext(os.path.basename(img))
 			parameterized_name = inflection.parameterize(imgname)
-			optimize_image(img, idst_dir, parameterized_name)
+			jobs[parameterized_name] = (img, idst_dir, parameterized_name, params)
+		# With fingerprinting the output name depends on the image contents
+		output_names = {name: manifest.output_name(name, job[0], params) if manifest else name for name, job in jobs.items()}
+		jobs = {output_names[name]: (src, dst, output_names[name], job_params) for name, (src, dst, _, job_params) in jobs.items()}
+		if pending is None:
+			optimize_images(list(jobs.values()), pool, manifest)
+		else:
+			submit_images(list(jobs.values()), pool, manifest, pending)
+
+		content, edges = rewrite_links(content, page, output_names, params['formats'])
 
-		# Write updated file
-		with open(os.path.join(dst_dir, inflection.parameterize(filename) + ".md"), 'w') as file:
-			file.write('---\n' + yaml.dump(header) + '---\n')
-			file.write(content)
+		# Write updated file, leaving it untouched if nothing changed so Hugo does not rebuild it
+		output_path = os.path.join(dst_dir, inflection.parameterize(filename) + ".md")
+		output = '---\n' + yaml.dump(header) + '---\n' + content
+		if not os.path.exists(output_path) or Path(output_path).read_text() != output:
+			with atomic_output(output_path) as tmp_path:
+				with open(tmp_path, 'w') as file:
+					file.write(output)
+
+		if links is not None:
+			links.update(page, edges)
 
 		print(f"Successfully processed {src_path} and saved to {dst_dir}")
+		return {'output': os.path.abspath(output_path), 'images': {base_name: job[0] for base_name, job in jobs.items()}}
+	except BrokenProcessPool:
+		raise
 	except Exception as e:
 		print(f"Error processing {src_path}: {str(e)}\n")
 
+def find_notes(vault_dir):
+	"""Markdown notes under vault_dir in sorted order, skipping hidden directories such as .obsidian and .trash."""
+	notes = []
+	for root, dirnames, filenames in os.walk(vault_dir):
+		dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+		notes.extend(os.path.join(root, name) for name in sorted(filenames) if name.endswith('.md'))
+	return notes
+
+def _stat_key(path):
+	stat = os.stat(path)
+	return [stat.st_size, stat.st_mtime_ns]
+
+def _note_unchanged(note_path, entry, manifest=None, params=IMAGE_PARAMS):
+	"""
+	True if the note and every image it embeds are unchanged since entry was recorded and its
+	output still exists. Size and mtime are compared first; the note is only hashed when they differ.
+	Images the manifest recorded with other encoder settings, or a manifest refresh, count as changes,
+	and so do images whose outputs are missing or damaged, or that were never recorded (fallback
+	copies and skipped images), so they are encoded again.
+	"""
+	if not os.path.exists(entry['output']):
+		return False
+	if manifest and not all(manifest.intact(base_name) for base_name in entry['images']):
+		return False
+	if manifest and (manifest.refresh or not all(manifest.satisfies(base_name, params) for base_name in entry['images'])):
+		return False
+	if manifest and any(('name' in manifest.images[base_name]) != manifest.fingerprint for base_name in entry['images'] if base_name in manifest.images):
+		return False
+	try:
+		if any(_stat_key(src_path) != stat for src_path, stat in entry['images'].values()):
+			return False
+	except OSError:
+		return False
+	return entry['stat'] == _stat_key(note_path) or entry['hash'] == hash_file(note_path)
+
+def sync_vault(vault_dir, dst_dir, image_index, idst_dir, pool=None, manifest=None, dates=None, state_path=DEFAULT_SYNC_STATE_PATH, links=None, params=IMAGE_PARAMS):
+	"""
+	Publish every note in vault_dir that changed since the last sync, together with its images.
+	Notes are compared by size and mtime, then by content hash, against the state recorded in
+	state_path. Outputs in dst_dir and idst_dir whose source note or embed no longer exists are
+	removed; only outputs recorded by an earlier sync are ever deleted.
+
+	Returns: dict of note path -> list of embedded image paths, for every synced note
+	"""
+	vault_dir = os.path.abspath(vault_dir)
+	state = read_json(state_path)
+	previous = state.get(vault_dir, {})
+	current = {}
+	published = 0
+	pending = {}
+
+	for note_path in find_notes(vault_dir):
+		name = os.path.relpath(note_path, vault_dir)
+		entry = previous.get(name)
+		if entry and _note_unchanged(note_path, entry, manifest, params):
+			current[name] = dict(entry, stat=_stat_key(note_path))
+			continue
+
+		result = process_file(note_path, dst_dir, image_index, idst_dir, pool, manifest, dates, links, params, pending)
+		if result is None:
+			# Keep ownership of the old outputs but force a retry on the next sync
+			if entry:
+				current[name] = dict(entry, stat=None, hash=None)
+			continue
+		published += 1
+		current[name] = {
+			'stat': _stat_key(note_path),
+			'hash': hash_file(note_path),
+			'output': result['output'],
+			'images': {base_name: [src_path, _stat_key(src_path)] for base_name, src_path in result['images'].items()},
+		}
+
+	# Images of every published note were queued together so the pool works across notes
+	collect_images(pending, manifest)
+
+	# Remove outputs whose source is gone
+	live_outputs = {entry['output'] for entry in current.values()}
+	live_images = {base_name for entry in current.values() for base_name in entry['images']}
+	removed = 0
+	for name, entry in previous.items():
+		if name not in current and entry['output'] not in live_outputs and os.path.exists(entry['output']):
+			os.remove(entry['output'])
+			removed += 1
+			if links is not None:
+				links.update(f"/blog/{os.path.splitext(os.path.basename(entry['output']))[0]}", [])
+			print(f"Removed {entry['output']} (source note {name} was deleted)")
+		for base_name in entry['images']:
+			if base_name not in live_images and manifest is not None:
+				for path in manifest.discard(base_name):
+					print(f"Removed {path} (no longer embedded by any note)")
+
+	state[vault_dir] = current
+	os.makedirs(os.path.dirname(state_path), exist_ok=True)
+	write_json_atomic(state_path, state)
+	print(f"Synced {vault_dir}: {published} published, {len(current) - published} unchanged, {removed} removed")
+	return {os.path.join(vault_dir, name): [src_path for src_path, _ in entry['images'].values()] for name, entry in current.items()}
+
+def publish_sources(src_paths, args, image_index, pool, manifest, dates, links):
+	"""
+	Publish the --source notes in src_paths, queueing the images of all of them before collecting
+	any, so the pool works across notes.
+
+	Returns: dict of note path -> list of embedded image paths, or None for notes that failed
+	"""
+	pending = {}
+	embeds = {}
+	for src_path in src_paths:
+		result = process_file(src_path, args.dest, image_index, args.idest, pool, manifest, dates, links, image_params(args), pending)
+		embeds[src_path] = list(result['images'].values()) if result else None
+	collect_images(pending, manifest)
+	return embeds
+
+def _snapshot(paths):
+	snapshot = {}
+	for path in paths:
+		try:
+			snapshot[path] = _stat_key(path)
+		except OSError:
+			snapshot[path] = None
+	return snapshot
+
+def watch(args, image_index, image_dirs, pool, manifest, dates, links, embeds):
+	"""
+	Stay resident and republish notes as they are saved.
+	The notes, the images they embed (embeds: note path -> image paths) and the image directories
+	are polled every args.interval seconds. Once nothing has changed for args.debounce seconds,
+	only the affected notes are republished, so a burst of autosaves results in a single publish.
+	The git history, image index and image manifest stay in memory between publishes; the index
+	is only rescanned when an image directory itself changes. If an image worker dies, the pool
+	is replaced and the republish is retried once on the next poll.
+	"""
+	def watched_paths():
+		notes = find_notes(args.vault) if args.vault else args.source
+		return [*notes, *(path for paths in embeds.values() for path in paths or []), *image_dirs]
+
+	print(f"Watching for changes (polling every {args.interval}s), press Ctrl+C to stop")
+	last = _snapshot(watched_paths())
+	changed, quiet_since = set(), None
+	replaced = retried = False
+	try:
+		while True:
+			time.sleep(args.interval)
+			current = _snapshot(watched_paths())
+			diff = {path for path in current.keys() | last.keys() if current.get(path) != last.get(path)}
+			last = current
+			if diff:
+				changed |= diff
+				quiet_since = time.monotonic()
+				continue
+			if not changed or time.monotonic() - quiet_since < args.debounce:
+				continue
+
+			started = time.monotonic()
+			index_changed = any(path in image_dirs for path in changed)
+			if index_changed:
+				image_dirs.clear()
+				image_index.clear()
+				image_index.update(build_image_index(args.imgdirs, args.index_cache, image_dirs))
+
+			try:
+				if args.vault:
+					embeds.clear()
+					embeds.update(sync_vault(args.vault, args.dest, image_index, args.idest, pool, manifest, dates, args.sync_state, links, image_params(args)))
+				else:
+					# Notes that failed last time (no embeds) may have been waiting for a new image
+					embeds.update(publish_sources([src_path for src_path in args.source if src_path in changed or any(path in changed for path in embeds[src_path] or [])
+						or (index_changed and embeds[src_path] is None)], args, image_index, pool, manifest, dates, links))
+			except BrokenProcessPool:
+				print("Warning: An image worker died, restarting the worker pool")
+				pool.shutdown(wait=False, cancel_futures=True)
+				pool, replaced = start_pool(args), True
+				# Retry the same notes once on the next poll; an image that kills its worker every
+				# time is left until the next change instead of being retried forever
+				retried = not retried
+				if not retried:
+					print("Warning: Giving up on these changes until the next save")
+					changed = set()
+				continue
+			retried = False
+
+			save_state(args, manifest, dates, links)
+			print(f"Republished in {(time.monotonic() - started) * 1000:.0f}ms")
+			changed = set()
+			# Keep the stats taken before publishing, so saves made meanwhile are picked up by the
+			# next poll; only paths watched for the first time (e.g. new embeds) are stat'ed now
+			paths = watched_paths()
+			last = {**_snapshot(path for path in paths if path not in last), **{path: last[path] for path in paths if path in last}}
+	finally:
+		# The pool passed in is shut down by the caller
+		if replaced:
+			pool.shutdown(cancel_futures=True)
+
+def _init_worker(max_pixels, max_memory_mb):
+	"""Pool initializer: apply the decode limits and leave Ctrl+C to the main process."""
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	configure_limits(max_pixels, max_memory_mb)
+
+def start_pool(args):
+	"""Process pool for image encodes with args.jobs workers, or None for --jobs 1."""
+	if args.jobs <= 1:
+		return None
+	return ProcessPoolExecutor(max_workers=args.jobs, initializer=_init_worker, initargs=(args.max_pixels, args.max_memory_mb))
+
+def referenced_images(content_dir):
+	"""Base names of the /images/ files linked from any markdown page under content_dir."""
+	referenced = set()
+	for path in find_notes(content_dir):
+		with open(path) as file:
+			referenced.update(re.findall(r'/images/([^/)\s]+?)\.(?:avif|webp|png)\b', file.read()))
+	return referenced
+
+def save_state(args, manifest, dates, links):
+	"""Persist the image manifest, date cache and link index, and rebuild the search index."""
+	if manifest.fingerprint:
+		# Every page of the site may link to images, not only the --dest section
+		for base_name in manifest.superseded(referenced_images(os.path.dirname(os.path.abspath(args.dest)))):
+			for path in manifest.discard(base_name):
+				print(f"Removed {path} (superseded fingerprint)")
+	manifest.save()
+	dates.save()
+	if links:
+		links.save()
+	if args.search_index:
+		# --dest is a section such as content/blog, so page ids are taken relative to its parent
+		page_count, shard_count = build_search_index(os.path.dirname(os.path.abspath(args.dest)), args.search_index, args.search_cache)
+		print(f"Indexed {page_count} pages into {shard_count} search shards")
+
 def main():
-	source_files, dst_dir, img_dirs, idst_dir = parse_args()
-	for src_path in source_files:
-		process_file(src_path, dst_dir, img_dirs, idst_dir)
+	args = parse_args()
+	image_dirs = {}
+	image_index = build_image_index(args.imgdirs, args.index_cache, image_dirs)
+	dates = CreationDateResolver(args.dates_cache)
+	links = LinkIndex(args.link_index) if args.link_index else None
+	manifest = ImageManifest(args.manifest, args.idest, refresh=args.force, fingerprint=args.fingerprint)
+	evicted = manifest.prune()
+	if evicted:
+		print(f"Evicted {len(evicted)} image manifest entries whose outputs were deleted")
+
+	configure_limits(args.max_pixels, args.max_memory_mb)
+	pool = start_pool(args)
+	try:
+		embeds = {}
+		if args.vault:
+			embeds = sync_vault(args.vault, args.dest, image_index, args.idest, pool, manifest, dates, args.sync_state, links, image_params(args))
+		embeds.update(publish_sources(args.source or [], args, image_index, pool, manifest, dates, links))
+		save_state(args, manifest, dates, links)
+		if args.watch:
+			watch(args, image_index, image_dirs, pool, manifest, dates, links, embeds)
+	except KeyboardInterrupt:
+		print("Stopped watching")
+	except BrokenProcessPool:
+		raise SystemExit("Error: An image worker died (out of memory?), images of the remaining notes were not encoded")
+	finally:
+		if pool:
+			# Workers ignore Ctrl+C, so finish the images in progress but drop the queued ones
+			pool.shutdown(cancel_futures=True)
+		manifest.save()
+		dates.save()
+		if links:
+			links.save()
 
 if __name__ == '__main__':
     main()
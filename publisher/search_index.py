@@ -0,0 +1,215 @@
+"""
+Compact, sharded client-side search index for the Hugo site.
+
+contentIndex.json ships the raw markdown of every page to every visitor. Instead, pages are
+reduced to plain-text terms and written to assets/indices/search/:
+  pages.json        {"pages": [{"id", "title", "tags"}, ...], "stopwords": [...]}, shards refer to pages by position
+  shard-<key>.json  {term: [[page, weight], ...]} for every term whose shard key is <key>
+
+The shard key is the first two characters of a term (or "_" for terms that do not start with
+two ASCII letters or digits). baseof.html fingerprints every file and publishes them under
+/indices/, so they can be cached immutably, and the client only downloads the shards for the
+terms it is looking up. The tokenizer and shard_key in baseof.html must stay in sync with the ones below.
+"""
+
+import json
+import os
+import re
+import tomllib
+import yaml
+from collections import Counter
+
+from image_manifest import atomic_output
+
+# Title terms count for more than body terms when ranking
+TITLE_WEIGHT = 5
+
+# Layout of the per-page term cache written by build_search_index
+CACHE_VERSION = 1
+
+STOPWORDS = frozenset("""
+a an and are as at be but by for from has have if in into is it its of on or so than that the
+their then there these this to was were which will with we you your our not can do does
+""".split())
+
+_FENCED_CODE = re.compile(r'^(```|~~~).*?^\1[^\n]*$', re.MULTILINE | re.DOTALL)
+_MATH = re.compile(r'\$\$.*?\$\$|\\\[.*?\\\]|\\\(.*?\\\)|(?<![\\$])\$(?!\s)[^$\n]+?\$', re.DOTALL)
+_INLINE_CODE = re.compile(r'`[^`\n]*`')
+_HTML = re.compile(r'<[^>]+>')
+_LINK = re.compile(r'!?\[([^\]]*)\]\([^)]*\)')
+_TERM = re.compile(r'[^\W_]+')
+_SHARD_KEY = re.compile(r'[a-z0-9]{2}')
+
+
+def split_front_matter(contents):
+    """Split a Hugo content file into (front matter dict, body), for YAML (---) and TOML (+++) headers."""
+    for delimiter, parse in (('---', yaml.safe_load), ('+++', tomllib.loads)):
+        if contents.startswith(delimiter + '\n'):
+            parts = contents.split(delimiter + '\n', 2)
+            if len(parts) == 3:
+                return parse(parts[1]) or {}, parts[2]
+    return {}, contents
+
+
+def strip_markdown(text):
+    """Reduce markdown to the words a reader sees: drop code, math, HTML and link targets."""
+    text = _FENCED_CODE.sub(' ', text)
+    text = _MATH.sub(' ', text)
+    text = _INLINE_CODE.sub(' ', text)
+    text = _HTML.sub(' ', text)
+    text = _LINK.sub(r'\1', text)
+    return text
+
+
+def tokenize(text):
+    """Lowercase terms of at least two characters, without stopwords."""
+    return [term for term in _TERM.findall(text.lower()) if len(term) > 1 and term not in STOPWORDS]
+
+
+def shard_key(term):
+    return term[:2] if _SHARD_KEY.fullmatch(term[:2]) else '_'
+
+
+def page_id(path, content_dir):
+    """Hugo path of a content file: content/blog/x.md -> /blog/x, content/_index.md -> /."""
+    relative = os.path.splitext(os.path.relpath(path, content_dir))[0].replace(os.sep, '/')
+    if relative == '_index' or relative.endswith('/_index'):
+        relative = relative[:-len('_index')].rstrip('/')
+    return '/' + relative
+
+
+def find_pages(content_dir):
+    pages = []
+    for root, dirnames, filenames in os.walk(content_dir):
+        dirnames.sort()
+        pages.extend(os.path.join(root, name) for name in sorted(filenames) if name.endswith('.md'))
+    return pages
+
+
+def _write_if_changed(path, text):
+    if os.path.exists(path):
+        with open(path) as file:
+            if file.read() == text:
+                return False
+    with atomic_output(path) as tmp_path:
+        with open(tmp_path, 'w') as file:
+            file.write(text)
+    return True
+
+
+def _dump(data):
+    return json.dumps(data, separators=(',', ':'), sort_keys=True, ensure_ascii=False)
+
+
+def _page_entry(path):
+    """Title, tags and term weights of one content file."""
+    with open(path) as file:
+        header, body = split_front_matter(file.read())
+    title = str(header.get('title') or os.path.splitext(os.path.basename(path))[0])
+    tags = header.get('topics') or header.get('tags') or []
+    weights = Counter(tokenize(strip_markdown(body)))
+    for term in tokenize(title):
+        weights[term] += TITLE_WEIGHT
+    return {'title': title, 'tags': [str(tag) for tag in tags], 'weights': weights}
+
+
+def _read_cache(cache_path, content_dir, output_dir):
+    """
+    The cache written by the last build into output_dir, or None if it is missing, was written
+    for other directories or does not describe the pages.json in output_dir anymore.
+    """
+    try:
+        with open(cache_path) as file:
+            cache = json.load(file)
+        with open(os.path.join(output_dir, 'pages.json')) as file:
+            ids = [page['id'] for page in json.load(file)['pages']]
+    except (OSError, ValueError, KeyError):
+        return None
+    if cache.get('version') != CACHE_VERSION or cache.get('dirs') != [content_dir, output_dir]:
+        return None
+    if ids != [page_id(os.path.join(content_dir, key), content_dir) for key in cache['order']]:
+        return None
+    return cache
+
+
+def _shard_files(output_dir):
+    return {name[len('shard-'):-len('.json')] for name in os.listdir(output_dir) if name.startswith('shard-') and name.endswith('.json')}
+
+
+def build_search_index(content_dir, output_dir, cache_path=None):
+    """
+    Rebuild the search index for every markdown page under content_dir into output_dir.
+    Only files whose contents changed are rewritten, and shards that no longer have any
+    terms are deleted, so unchanged shards keep their fingerprint and stay cached.
+
+    With cache_path, the size, mtime, title, tags and shard keys of every page are kept
+    between builds. Only pages changed since the last build are tokenized again, and only
+    the shards holding their old or new terms are read back and patched. Adding or removing
+    a page shifts the positions of the pages after it, so then every shard is patched, still
+    without tokenizing the unchanged pages.
+
+    Returns: (number of pages, number of shards)
+    """
+    content_dir, output_dir = os.path.abspath(content_dir), os.path.abspath(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    cache = _read_cache(cache_path, content_dir, output_dir) if cache_path else None
+    cached, order = (cache['pages'], cache['order']) if cache else ({}, [])
+
+    stats = {}
+    for path in find_pages(content_dir):
+        stat = os.stat(path)
+        stats[os.path.relpath(path, content_dir)] = [stat.st_size, stat.st_mtime_ns]
+    keys = list(stats)
+    changed = [key for key in keys if key not in cached or cached[key]['stat'] != stats[key]]
+    if cache and not changed and keys == order:
+        return len(keys), cache['shards']
+
+    entries = {key: _page_entry(os.path.join(content_dir, key)) for key in changed}
+    stale = set(changed) | (set(order) - set(stats))
+    position = {key: i for i, key in enumerate(keys)}
+    # Old position -> new position of every cached page whose postings are kept
+    moved = [None if key in stale else position[key] for key in order]
+    additions = {}
+    for key, entry in entries.items():
+        for term, weight in entry['weights'].items():
+            additions.setdefault(shard_key(term), {}).setdefault(term, []).append([position[key], weight])
+
+    # Shards to patch; without a cache, every shard on disk is rebuilt (or deleted) from scratch
+    touched = set(additions)
+    if keys == order:
+        touched.update(shard for key in changed if key in cached for shard in cached[key]['shards'])
+    else:
+        touched.update(_shard_files(output_dir))
+    for shard in touched:
+        path = os.path.join(output_dir, f'shard-{shard}.json')
+        terms = {}
+        if cache and os.path.exists(path):
+            with open(path) as file:
+                for term, postings in json.load(file).items():
+                    kept = [[moved[page], weight] for page, weight in postings if moved[page] is not None]
+                    if kept:
+                        terms[term] = kept
+        for term, postings in additions.get(shard, {}).items():
+            terms[term] = sorted(terms.get(term, []) + postings)
+        if terms:
+            _write_if_changed(path, _dump(terms))
+        elif os.path.exists(path):
+            os.remove(path)
+
+    pages = []
+    for key in keys:
+        if key in entries:
+            entry = entries[key]
+            cached[key] = {'stat': stats[key], 'title': entry['title'], 'tags': entry['tags'],
+                           'shards': sorted({shard_key(term) for term in entry['weights']})}
+        pages.append({'id': page_id(os.path.join(content_dir, key), content_dir), 'title': cached[key]['title'], 'tags': cached[key]['tags']})
+    _write_if_changed(os.path.join(output_dir, 'pages.json'), _dump({'pages': pages, 'stopwords': sorted(STOPWORDS)}))
+
+    shard_count = len(_shard_files(output_dir))
+    if cache_path:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with atomic_output(cache_path) as tmp_path:
+            with open(tmp_path, 'w') as file:
+                file.write(_dump({'version': CACHE_VERSION, 'dirs': [content_dir, output_dir], 'order': keys,
+                                  'pages': {key: cached[key] for key in keys}, 'shards': shard_count}))
+    return len(pages), shard_count
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Re-encode the images published with --profile draft at release settings.
+
+Draft encodes are recorded in the image manifest together with the path of their source.
+Run this before deploying (or in the background after a writing session); every draft
+whose source is unchanged is encoded again under the same name, so no page has to change.
+"""
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+
+from image_manifest import DEFAULT_MANIFEST_PATH, ImageManifest, release_params
+from imaging import DEFAULT_MAX_MEMORY_MB, DEFAULT_MAX_PIXELS, configure_limits
+from publisher import SITE_DIR, optimize_images
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Re-encode draft images recorded in the image manifest at release settings.")
+    parser.add_argument("--idest", default=os.path.join(SITE_DIR, 'static', 'images'), help="Directory holding the encoded images (default: the Hugo static/images directory)")
+    parser.add_argument("--manifest", default=DEFAULT_MANIFEST_PATH, help="Image manifest listing the drafts (default: the Hugo data/images.json file)")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="Number of worker processes used to encode images (default: number of CPU cores, 1 disables the pool)")
+    parser.add_argument("--max-memory-mb", type=int, default=DEFAULT_MAX_MEMORY_MB, help=f"Estimated peak memory one worker may use to decode an image (default: {DEFAULT_MAX_MEMORY_MB})")
+    parser.add_argument("--max-pixels", type=int, default=DEFAULT_MAX_PIXELS, help=f"Images with more pixels are skipped instead of decoded (default: {DEFAULT_MAX_PIXELS})")
+    args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error(f"--jobs must be at least 1, got {args.jobs}")
+    return args
+
+
+def main():
+    args = parse_args()
+    manifest = ImageManifest(args.manifest, args.idest)
+
+    jobs = []
+    for base_name in manifest.drafts():
+        entry = manifest.images[base_name]
+        src_path = entry.get('source_path')
+        if not src_path or not os.path.exists(src_path):
+            print(f"  Warning: Source of draft {base_name} is gone, republish it to upgrade")
+            continue
+        if manifest.source_key(base_name, src_path)['source_hash'] != entry['source_hash']:
+            print(f"  Warning: {src_path} changed since draft {base_name} was encoded, republish it to upgrade")
+            continue
+        jobs.append((src_path, args.idest, base_name, release_params(entry['params'])))
+
+    if not jobs:
+        print("No draft images to upgrade")
+        return
+
+    print(f"Upgrading {len(jobs)} draft images")
+    try:
+        limits = (args.max_pixels, args.max_memory_mb)
+        configure_limits(*limits)
+        with ProcessPoolExecutor(max_workers=args.jobs, initializer=configure_limits, initargs=limits) if args.jobs > 1 else nullcontext() as pool:
+            optimize_images(jobs, pool, manifest)
+    finally:
+        manifest.save()
+    remaining = set(manifest.drafts())
+    print(f"{sum(base_name not in remaining for _, _, base_name, _ in jobs)} of {len(jobs)} drafts upgraded")
+
+
+if __name__ == '__main__':
+    main()